@@ -17,7 +17,11 @@ from torch.utils.tensorboard import SummaryWriter
 from model import *
 from utils import *
 from config import getConfig
-from datasets.loader_cifar import CIFAR10, get_augmentation
+from engine import Engine
+from checkpoint import CheckpointWriter, RunState, seek_loader
+from distributed import init_distributed, get_rank, is_main_process, unwrap, sampler_args
+from datasets.loader_cifar import CIFAR10Source
+from datasets.batch_augment import get_views, to_device_views
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -27,28 +31,33 @@ class Trainer():
         self.args = args
         assert args.feature_dim != 0
         self.device = torch.device('cuda' if torch.cuda.is_available() and args.device == 'cuda' else 'cpu')
+        self.engine = Engine(self.device, args.amp, args.compile, args.micro_batch_size, args.time_stages)
 
         encoder = Network(args).to(self.device)
         decoder = Decoder(args.feature_dim).to(self.device)
         classifier = Classification_Head(args).to(self.device)
         self.model = AutoEncoder(encoder, decoder, classifier)
-
-        self.train_ds = CIFAR10(args.data_path, split='label', download=True, transform=get_augmentation(ver=2),
-                           boundary=0) + \
-                   CIFAR10(args.data_path, split='unlabel', download=True, transform=get_augmentation(ver=2),
-                           boundary=0)
-        self.finetune_ds = CIFAR10(args.data_path, split='label', download=True, transform=get_augmentation(ver=2),
-                                boundary=0)
-        self.val_ds = CIFAR10(args.data_path, split='valid', download=True, transform=get_augmentation(ver=1), boundary=0)
-        self.test_ds = CIFAR10(args.data_path, split='test', download=True, transform=get_augmentation(ver=1), boundary=0)
-
-        self.train_dl = DataLoader(self.train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-        self.finetune_dl = DataLoader(self.finetune_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-        self.val_dl = DataLoader(self.val_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
-        self.test_dl = DataLoader(self.test_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        self.engine.compile(self.model)
+        # 사전학습은 classifier, finetune은 decoder를 쓰지 않음
+        self.model = self.engine.distribute(self.model, find_unused_parameters=True)
+
+        self.source = CIFAR10Source(args.data_path, download=True, boundary=0, num_valid=args.num_valid,
+                                    num_label=args.num_label, seed=args.split_seed)
+        self.train_ds = get_views(self.source.split('label') + self.source.split('unlabel'), [2], args)
+        self.finetune_ds = get_views(self.source.split('label'), [2], args)
+        self.val_ds = get_views(self.source.split('valid'), [1], args)
+        self.test_ds = get_views(self.source.split('test'), [1], args)
+
+        self.train_dl = to_device_views(DataLoader(self.train_ds, batch_size=args.batch_size, **sampler_args(self.train_ds, shuffle=True, seed=args.seed), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [2], args, self.device, timer=self.engine.timer)
+        self.engine.total_steps = args.epochs * len(self.train_dl)
+        self.finetune_dl = to_device_views(DataLoader(self.finetune_ds, batch_size=args.batch_size, **sampler_args(self.finetune_ds, shuffle=True, seed=args.seed), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [2], args, self.device, timer=self.engine.timer)
+        self.val_dl = to_device_views(DataLoader(self.val_ds, batch_size=args.batch_size, **sampler_args(self.val_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.test_dl = to_device_views(DataLoader(self.test_ds, batch_size=args.batch_size, **sampler_args(self.test_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
 
         self.save_path = args.save_path
-        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard else None
+        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard and is_main_process() else None
+        self.checkpoint = CheckpointWriter()
+        self.run = RunState(args, self.checkpoint, ['train', 'finetune'])
         self.aeloss = nn.MSELoss()
         self.criterion = nn.CrossEntropyLoss()
 
@@ -66,6 +75,10 @@ class Trainer():
             self.scheduler = torch.optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=args.max_lr,
                                                               steps_per_epoch=iter_per_epoch, epochs=args.epochs)
 
+    def state_objects(self):
+        return {'model': unwrap(self.model), 'optimizer': self.optimizer, 'scheduler': self.scheduler,
+                'scaler': self.engine.scaler, 'stopper': self.stopper}
+
     def close_writer(self):
         if self.writer is not None:
             self.writer.close()
@@ -76,21 +89,23 @@ class Trainer():
         return noisy_img
 
     def train(self):
+        if self.run.done('train'):
+            return
         self.init_settings(self.args)
         start = time.time()
 
         # Early stopping
-        best_epoch = 0
-        best_loss = np.inf
-        early_stopping = 0
+        self.stopper = EarlyStopping(self.args.patience, mode='loss')
+        start_epoch, start_step = self.run.restore('train', self.state_objects())
 
-        for epoch in range(self.args.epochs):
+        for epoch in range(start_epoch, self.args.epochs):
 
             if self.args.scheduler == 'cos':
-                if epoch > self.args.warm_epoch:
+                if epoch > self.args.warm_epoch and not start_step:
                     self.scheduler.step()
 
-            train_loss = self.train_one_epoch()
+            train_loss = self.train_one_epoch(epoch, start_step)
+            start_step = 0
             val_loss = self.validate(False)
 
             if self.writer is not None:
@@ -99,53 +114,54 @@ class Trainer():
                 self.writer.add_scalar('Val/mse', val_loss, epoch)
 
             print(f'Epoch : {epoch} | Train Loss:{train_loss:.4f} | Val Loss:{val_loss:.4f}')
-            state_dict = self.model.state_dict()
-
-            if val_loss < best_loss:
-                early_stopping = 0
-                best_epoch = epoch
-                best_loss = val_loss
-
-                torch.save({'epoch': epoch,
-                            'state_dict': state_dict,
-                            'optimizer': self.optimizer.state_dict(),
-                            'scheduler': self.scheduler.state_dict(),
-                            }, os.path.join(self.save_path, 'best_model.pth'))
-            else:
-                early_stopping += 1
+            state_dict = unwrap(self.model).state_dict()
+
+            if self.stopper.update(epoch, val_loss):
+                self.checkpoint.save({'epoch': epoch,
+                                      'state_dict': state_dict,
+                                      'optimizer': self.optimizer.state_dict(),
+                                      'scheduler': self.scheduler.state_dict(),
+                                      }, os.path.join(self.save_path, 'best_model.pth'))
 
-            if early_stopping == self.args.patience:
+            self.run.save('train', self.args.epochs if self.stopper.stop else epoch + 1, 0, self.state_objects())
+            if self.stopper.stop:
                 break
 
             if self.writer is not None:
-                self.writer.add_scalar('Best/mse', best_loss, epoch)
+                self.writer.add_scalar('Best/mse', self.stopper.best_loss, epoch)
 
         end = time.time()
-        print(f'Best Epoch:{best_epoch} | Best Loss:{best_loss:.4f}')
+        print(f'Best Epoch:{self.stopper.best_epoch} | Best Loss:{self.stopper.best_loss:.4f}')
         print(f'Total Training time:{(end - start) / 60:.3f}Minute')
 
-    def train_one_epoch(self):
+    def train_one_epoch(self, epoch, start_step=0):
         self.model.train()
-        train_loss = 0
+        meter = MetricMeter(self.device, log_interval=self.args.log_interval)
+        self.run.load('meter', meter)
+        seek_loader(self.train_dl, epoch, start_step)
 
-        for images, _ in tqdm(self.train_dl):
-            images = torch.tensor(images, device=self.device, dtype=torch.float32)
+        pbar = tqdm(self.engine.timer.iterate(self.train_dl, self.writer), total=len(self.train_dl), initial=start_step)
+        for step, (images, _) in enumerate(pbar, start_step + 1):
             images_noise = self.add_noise(images) # Only Difference with AE
 
             self.model.zero_grad(set_to_none=True)
 
-            preds = self.model(images_noise, False)
+            loss = self.engine.accumulate(self.train_step, (images_noise, images), self.optimizer)
 
-            loss = self.aeloss(preds, images)
-            loss.backward()
-
-            self.optimizer.step()
+            meter.update(images.size(0), loss=loss)
+            meter.log(pbar)
+            if self.run.due(step):
+                self.run.save('train', epoch, step, dict(self.state_objects(), meter=meter))
 
-            train_loss += loss.item()
+        self.engine.timer.save(os.path.join(self.save_path, 'timing.jsonl'), phase='train', epoch=epoch)
+        return meter.compute('loss')
 
-        train_loss /= len(self.train_dl)
+    def train_step(self, inputs, images):
+        with self.engine.autocast():
+            preds = self.model(inputs, False)
 
-        return train_loss
+            loss = self.aeloss(preds, images)
+        return loss
 
     def finetune(self):
         self.args.lr /= 2
@@ -153,19 +169,17 @@ class Trainer():
         start = time.time()
 
         # Early stopping
-        best_epoch = 0
-        best_loss = np.inf
-        best_acc = 0
-        best_acc2 = 0
-        early_stopping = 0
+        self.stopper = EarlyStopping(self.args.patience)
+        start_epoch, start_step = self.run.restore('finetune', self.state_objects())
 
-        for epoch in range(self.args.epochs):
+        for epoch in range(start_epoch, self.args.epochs):
 
             if self.args.scheduler == 'cos':
-                if epoch > self.args.warm_epoch:
+                if epoch > self.args.warm_epoch and not start_step:
                     self.scheduler.step()
 
-            train_loss, train_top1, train_top5 = self.finetune_one_epoch()
+            train_loss, train_top1, train_top5 = self.finetune_one_epoch(epoch, start_step)
+            start_step = 0
             val_loss, val_top1, val_top5 = self.validate(True)
 
             if self.writer is not None:
@@ -179,114 +193,91 @@ class Trainer():
 
             print(f'Epoch : {epoch} | Train Loss:{train_loss:.4f} | Train Top1:{train_top1:.4f} | Train Top5:{train_top5:.4f}')
             print(f'Epoch : {epoch} | Val Loss:{val_loss:.4f}   | Val Top1:{val_top1:.4f}   | Val Top5:{val_top5:.4f}')
-            state_dict = self.model.state_dict()
-
-            if val_top1 > best_acc:
-                early_stopping = 0
-                best_epoch = epoch
-                best_loss = val_loss
-                best_acc = val_top1
-                best_acc2 = val_top5
-
-                torch.save({'epoch' :epoch,
-                            'state_dict' :state_dict,
-                            'optimizer': self.optimizer.state_dict(),
-                            'scheduler': self.scheduler.state_dict(),
-                            }, os.path.join(self.save_path, 'best_model.pth'))
-            else:
-                early_stopping += 1
+            state_dict = unwrap(self.model).state_dict()
+
+            if self.stopper.update(epoch, val_loss, val_top1, val_top5):
+                self.checkpoint.save({'epoch' :epoch,
+                                      'state_dict' :state_dict,
+                                      'optimizer': self.optimizer.state_dict(),
+                                      'scheduler': self.scheduler.state_dict(),
+                                      }, os.path.join(self.save_path, 'best_model.pth'))
 
-            if early_stopping == self.args.patience:
+            self.run.save('finetune', self.args.epochs if self.stopper.stop else epoch + 1, 0, self.state_objects())
+            if self.stopper.stop:
                 break
 
             if self.writer is not None:
-                self.writer.add_scalar('Finetune/Best/top1_accuracy', best_acc, epoch)
-                self.writer.add_scalar('Finetune/Best/top5_accuracy', best_acc2, epoch)
-                self.writer.add_scalar('Finetune/Best/loss', best_loss, epoch)
+                self.writer.add_scalar('Finetune/Best/top1_accuracy', self.stopper.best_acc, epoch)
+                self.writer.add_scalar('Finetune/Best/top5_accuracy', self.stopper.best_acc2, epoch)
+                self.writer.add_scalar('Finetune/Best/loss', self.stopper.best_loss, epoch)
 
         end = time.time()
-        print(f'Best Epoch:{best_epoch} | Loss:{best_loss:.4f} | Top1:{best_acc:.4f} | Top5:{best_acc2:.4f}')
+        print(f'Best Epoch:{self.stopper.best_epoch} | Loss:{self.stopper.best_loss:.4f} | Top1:{self.stopper.best_acc:.4f} | Top5:{self.stopper.best_acc2:.4f}')
         print(f'Total Training time:{(end - start) / 60:.3f}Minute')
 
-    def finetune_one_epoch(self):
+    def finetune_one_epoch(self, epoch, start_step=0):
         self.model.train()
-        train_loss = 0
-        top1 = 0
-        top5 = 0
-
-        for images, targets in tqdm(self.finetune_dl):
-            images = torch.tensor(images, device=self.device, dtype=torch.float32)
-            targets = torch.tensor(targets, device=self.device, dtype=torch.long)
+        meter = MetricMeter(self.device, log_interval=self.args.log_interval)
+        self.run.load('meter', meter)
+        seek_loader(self.finetune_dl, epoch, start_step)
 
+        pbar = tqdm(self.engine.timer.iterate(self.finetune_dl, self.writer), total=len(self.finetune_dl), initial=start_step)
+        for step, (images, targets) in enumerate(pbar, start_step + 1):
             self.model.zero_grad(set_to_none=True)
 
-            preds = self.model(images, True)
+            loss, preds = self.engine.accumulate(self.finetune_step, (images, targets), self.optimizer)
 
-            loss = self.criterion(preds, targets)
-            loss.backward()
+            meter.update(targets.size(0), preds, targets, loss=loss)
+            meter.log(pbar)
+            if self.run.due(step):
+                self.run.save('finetune', epoch, step, dict(self.state_objects(), meter=meter))
 
-            self.optimizer.step()
+        self.engine.timer.save(os.path.join(self.save_path, 'timing.jsonl'), phase='finetune', epoch=epoch)
+        return meter.compute('loss', 'top1', 'top5') #train_acc
 
-            t1, t5 = accuracy(preds, targets, (1, 5))
-            train_loss += loss.item()
-            top1 += t1
-            top5 += t5
-
-        top1 /= len(self.finetune_dl)
-        top5 /= len(self.finetune_dl)
-        train_loss /= len(self.finetune_dl)
+    def finetune_step(self, images, targets):
+        with self.engine.autocast():
+            preds = self.model(images, True)
 
-        return train_loss, top1, top5 #train_acc
+            loss = self.criterion(preds, targets)
+        return loss, preds
 
     def validate(self, finetune=False):
         self.model.eval()
-        with torch.no_grad():
-            val_loss = 0
-            top1 = 0
-            top5 = 0
+        with torch.no_grad(), self.engine.autocast():
+            meter = MetricMeter(self.device)
 
             if finetune:
                 for images, targets in tqdm(self.val_dl):
-                    images = torch.tensor(images, device=self.device, dtype=torch.float32)
-                    targets = torch.tensor(targets, device=self.device, dtype=torch.long)
-
                     preds = self.model(images, finetune)
                     loss = self.criterion(preds, targets)
 
                     # Metric
-                    t1, t5 = accuracy(preds, targets, (1, 5))
-                    val_loss += loss.item()
-                    top1 += t1
-                    top5 += t5
-
-                top1 /= len(self.val_dl)
-                top5 /= len(self.val_dl)
-                val_loss /= len(self.val_dl)
-                return val_loss, top1, top5
+                    meter.update(targets.size(0), preds, targets, loss=loss)
+
+                return meter.compute('loss', 'top1', 'top5')
             else:
                 for images, _ in tqdm(self.val_dl):
-                    images = torch.tensor(images, device=self.device, dtype=torch.float32)
-
                     preds = self.model(images, finetune)
                     loss = self.aeloss(preds, images)
 
                     # Metric
-                    val_loss += loss.item()
+                    meter.update(images.size(0), loss=loss)
 
-                val_loss /= len(self.val_dl)
-                return val_loss
+                return meter.compute('loss')
 
     def test(self):
         pass
 
 if __name__ == '__main__':
     args = getConfig()
+    init_distributed(args)
 
     print('<---- Training Params ---->')
     pprint.pprint(args)
 
     # Random Seed
-    seed = args.seed
+    seed = args.seed + get_rank()
     os.environ['PYTHONHASHSEED'] = str(seed)
     random.seed(seed)
     np.random.seed(seed)
@@ -16,9 +16,15 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from model import Network
-from utils import accuracy, VATLoss
+from utils import MetricMeter, EarlyStopping, VATLoss
 from config import getConfig
-from datasets.loader_cifar import CIFAR10, get_augmentation
+from engine import Engine
+from ema import ModelEMA
+from checkpoint import CheckpointWriter, RunState, seek_loader
+from distributed import init_distributed, get_rank, is_main_process, unwrap, sampler_args
+from datasets.loader_cifar import CIFAR10Source
+from datasets.infinite import InfiniteLoader
+from datasets.batch_augment import get_views, get_unlabel_views, to_device_views
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -27,23 +33,34 @@ class Trainer():
     def __init__(self, args):
         self.args = args
         self.device = torch.device('cuda' if torch.cuda.is_available() and args.device == 'cuda' else 'cpu')
+        self.engine = Engine(self.device, args.amp, args.compile, args.micro_batch_size, args.time_stages)
         self.model = Network(args).to(self.device)
-
-        self.train_ds = CIFAR10(args.data_path, split='label', download=True, transform=get_augmentation(ver=2), boundary=0)
-        self.unlabel_ds = CIFAR10(args.data_path, split='unlabel', download=True, transform=get_augmentation(ver=2), boundary=0)
-        self.val_ds = CIFAR10(args.data_path, split='valid', download=True, transform=get_augmentation(ver=1), boundary=0)
-        self.test_ds = CIFAR10(args.data_path, split='test', download=True, transform=get_augmentation(ver=1), boundary=0)
-
-        self.train_dl = DataLoader(self.train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=True)
-        self.unlabel_dl = DataLoader(self.unlabel_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=True)
-        self.val_dl = DataLoader(self.val_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
-        self.test_dl = DataLoader(self.test_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        self.engine.compile(self.model)
+        self.model = self.engine.distribute(self.model)
+
+        self.source = CIFAR10Source(args.data_path, download=True, boundary=0, num_valid=args.num_valid,
+                                    num_label=args.num_label, seed=args.split_seed)
+        self.train_ds = get_views(self.source.split('label'), [2], args)
+        self.unlabel_ds = get_unlabel_views(self.source, [2], args)
+        self.val_ds = get_views(self.source.split('valid'), [1], args)
+        self.test_ds = get_views(self.source.split('test'), [1], args)
+
+        self.labeled_dl = to_device_views(InfiniteLoader(self.train_ds, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=self.device.type == 'cuda', seed=args.seed,
+                                                         on_wrap=lambda: self.scheduler.step()), [2], args, self.device, timer=self.engine.timer)
+        self.labeled_iter = iter(self.labeled_dl)
+        self.unlabel_dl = to_device_views(DataLoader(self.unlabel_ds, batch_size=args.batch_size, **sampler_args(self.unlabel_ds, shuffle=True, seed=args.seed), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda', drop_last=True), [2], args, self.device, timer=self.engine.timer)
+        self.val_dl = to_device_views(DataLoader(self.val_ds, batch_size=args.batch_size, **sampler_args(self.val_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.test_dl = to_device_views(DataLoader(self.test_ds, batch_size=args.batch_size, **sampler_args(self.test_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.engine.total_steps = args.epochs * len(self.unlabel_dl)
 
         self.save_path = args.save_path
-        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard else None
+        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard and is_main_process() else None
+        self.checkpoint = CheckpointWriter()
+        self.run = RunState(args, self.checkpoint, ['train'])
         self.criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
-        self.vadv_loss = VATLoss(xi=args.xi, eps=args.eps, ip=args.ip)
+        self.vadv_loss = VATLoss(xi=args.xi, eps=args.eps, ip=args.ip, hvp=args.vat_hvp, timer=self.engine.timer)
         self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=args.lr)
+        self.ema = ModelEMA(self.model, args.ema_decay, args.ema_every, args.ema_buffers) if args.ema_decay > 0 else None
 
         if args.scheduler == 'step':
             self.scheduler = torch.optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=args.milestone,
@@ -56,6 +73,17 @@ class Trainer():
             self.scheduler = torch.optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=args.max_lr,
                                                               steps_per_epoch=iter_per_epoch, epochs=args.epochs)
 
+    def state_objects(self):
+        objects = {'model': unwrap(self.model), 'optimizer': self.optimizer, 'scheduler': self.scheduler,
+                   'scaler': self.engine.scaler, 'stopper': self.stopper}
+        if self.ema is not None:
+            objects['ema'] = self.ema
+        return objects
+
+    def eval_model(self):
+        """The model that is validated and saved as the best model: the EMA if enabled."""
+        return unwrap(self.model) if self.ema is None else self.ema.module
+
     def close_writer(self):
         if self.writer is not None:
             self.writer.close()
@@ -64,19 +92,18 @@ class Trainer():
         start = time.time()
 
         # Early stopping
-        best_epoch = 0
-        best_loss = np.inf
-        best_acc = 0
-        best_acc2 = 0
-        early_stopping = 0
-
-        for epoch in range(self.args.epochs):
+        self.stopper = EarlyStopping(self.args.patience)
+        start_epoch, start_step = self.run.restore('train', self.state_objects())
+        # 학습 step마다 labeled batch 하나를 사용
+        self.labeled_dl.loader.resume(start_epoch * len(self.unlabel_dl) + start_step)
 
+        for epoch in range(start_epoch, self.args.epochs):
             if self.args.scheduler == 'cos':
-                if epoch > self.args.warm_epoch:
+                if epoch > self.args.warm_epoch and not start_step:
                     self.scheduler.step()
 
-            train_loss, train_top1, train_top5 = self.train_one_epoch()
+            train_loss, train_top1, train_top5 = self.train_one_epoch(epoch, start_step)
+            start_step = 0
             val_loss, val_top1, val_top5 = self.validate()
 
             if self.writer is not None:
@@ -90,115 +117,90 @@ class Trainer():
 
             print(f'Epoch : {epoch} | Train Loss:{train_loss:.4f} | Train Top1:{train_top1:.4f} | Train Top5:{train_top5:.4f}')
             print(f'Epoch : {epoch} | Val Loss:{val_loss:.4f}   | Val Top1:{val_top1:.4f}   | Val Top5:{val_top5:.4f}')
-            state_dict = self.model.state_dict()
-
-            if val_top1 > best_acc:
-                early_stopping = 0
-                best_epoch = epoch
-                best_loss = val_loss
-                best_acc = val_top1
-                best_acc2 = val_top5
-
-                torch.save({'epoch' :epoch,
-                            'state_dict' :state_dict,
-                            'optimizer': self.optimizer.state_dict(),
-                            'scheduler': self.scheduler.state_dict(),
-                            }, os.path.join(self.save_path, 'best_model.pth'))
-            else:
-                early_stopping += 1
-
-            if early_stopping == self.args.patience:
+            state_dict = self.eval_model().state_dict()
+
+            if self.stopper.update(epoch, val_loss, val_top1, val_top5):
+                self.checkpoint.save({'epoch' :epoch,
+                                      'state_dict' :state_dict,
+                                      'optimizer': self.optimizer.state_dict(),
+                                      'scheduler': self.scheduler.state_dict(),
+                                      }, os.path.join(self.save_path, 'best_model.pth'))
+
+            self.run.save('train', self.args.epochs if self.stopper.stop else epoch + 1, 0, self.state_objects())
+            if self.stopper.stop:
                 break
 
             if self.writer is not None:
-                self.writer.add_scalar('Best/top1_accuracy', best_acc, epoch)
-                self.writer.add_scalar('Best/top5_accuracy', best_acc2, epoch)
-                self.writer.add_scalar('Best/loss', best_loss, epoch)
+                self.writer.add_scalar('Best/top1_accuracy', self.stopper.best_acc, epoch)
+                self.writer.add_scalar('Best/top5_accuracy', self.stopper.best_acc2, epoch)
+                self.writer.add_scalar('Best/loss', self.stopper.best_loss, epoch)
 
         end = time.time()
-        print(f'Best Epoch:{best_epoch} | Loss:{best_loss:.4f} | Top1:{best_acc:.4f} | Top5:{best_acc2:.4f}')
+        print(f'Best Epoch:{self.stopper.best_epoch} | Loss:{self.stopper.best_loss:.4f} | Top1:{self.stopper.best_acc:.4f} | Top5:{self.stopper.best_acc2:.4f}')
         print(f'Total Training time:{(end - start) / 60:.3f}Minute')
 
-    def train_one_epoch(self):
+    def train_one_epoch(self, epoch, start_step=0):
         self.model.train()
-        train_loss = 0
-        top1 = 0
-        top5 = 0
-
-        labeled_iter = iter(self.train_dl)
-        for images_us, _ in tqdm(self.unlabel_dl):
-            images_us = torch.tensor(images_us, device=self.device, dtype=torch.float32)
+        meter = MetricMeter(self.device, log_interval=self.args.log_interval)
+        self.run.load('meter', meter)
+        seek_loader(self.unlabel_dl, epoch, start_step)
 
+        pbar = tqdm(self.engine.timer.iterate(self.unlabel_dl, self.writer), total=len(self.unlabel_dl), initial=start_step)
+        for step, (images_us, _) in enumerate(pbar, start_step + 1):
             #Get labeled data
-            try:
-                images_l, targets = labeled_iter.next()
-            except:
-                self.scheduler.step()
-                labeled_iter = iter(self.train_dl)
-                images_l, targets = labeled_iter.next()
-
-            images_l = torch.tensor(images_l, device=self.device, dtype=torch.float32)
-            targets_l = torch.tensor(targets, device=self.device, dtype=torch.long)
+            with self.engine.timer.stage('data'):
+                images_l, targets_l = next(self.labeled_iter)
 
             self.model.zero_grad(set_to_none=True)
 
+            loss, preds_l = self.engine.accumulate(self.train_step, (images_l, targets_l, images_us), self.optimizer)
+            if self.ema is not None:
+                self.ema.update()
+
+            meter.update(targets_l.size(0), preds_l, targets_l, loss=loss)
+            meter.log(pbar)
+            if self.run.due(step):
+                self.run.save('train', epoch, step, dict(self.state_objects(), meter=meter))
+
+        self.engine.timer.save(os.path.join(self.save_path, 'timing.jsonl'), phase='train', epoch=epoch)
+        return meter.compute('loss', 'top1', 'top5')
+
+    def train_step(self, images_l, targets_l, images_us):
+        with self.engine.autocast():
             preds_l = self.model(images_l)
             loss_l = self.criterion(preds_l, targets_l) # labeled
             loss_vadv = self.vadv_loss(self.model, images_us) # unlabeld
 
             loss = loss_l + self.args.lambda_u * loss_vadv
-            loss.backward()
-
-            self.optimizer.step()
-
-            t1, t5 = accuracy(preds_l, targets_l, (1, 5))
-            train_loss += loss.item()
-            top1 += t1
-            top5 += t5
-
-        top1 /= len(self.unlabel_dl)
-        top5 /= len(self.unlabel_dl)
-        train_loss /= len(self.unlabel_dl)
-
-        return train_loss, top1, top5
+        return loss, preds_l
 
     def validate(self):
-        self.model.eval()
-        with torch.no_grad():
-            val_loss = 0
-            top1 = 0
-            top5 = 0
+        model = self.eval_model()
+        model.eval()
+        with torch.no_grad(), self.engine.autocast():
+            meter = MetricMeter(self.device)
 
             for images, targets in tqdm(self.val_dl):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
-                targets = torch.tensor(targets, device=self.device, dtype=torch.long)
-
-                preds = self.model(images)
+                preds = model(images)
                 loss = self.criterion(preds, targets)
 
                 # Metric
-                t1, t5 = accuracy(preds, targets, (1, 5))
-                val_loss += loss.item()
-                top1 += t1
-                top5 += t5
-
-            top1 /= len(self.val_dl)
-            top5 /= len(self.val_dl)
-            val_loss /= len(self.val_dl)
+                meter.update(targets.size(0), preds, targets, loss=loss)
 
-        return val_loss, top1, top5
+        return meter.compute('loss', 'top1', 'top5')
 
     def test(self):
         pass
 
 if __name__ == '__main__':
     args = getConfig()
+    init_distributed(args)
 
     print('<---- Training Params ---->')
     pprint.pprint(args)
 
     # Random Seed
-    seed = args.seed
+    seed = args.seed + get_rank()
     os.environ['PYTHONHASHSEED'] = str(seed)
     random.seed(seed)
     np.random.seed(seed)
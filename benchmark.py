@@ -0,0 +1,131 @@
+"""Micro-benchmarks of training components.
+
+    python benchmark.py ema --encoder_name resnet50 --device cuda
+    python benchmark.py mpl --encoder_name resnet18 --batch_size 64 --device cuda
+    python benchmark.py vat --encoder_name resnet18 --batch_size 64 --ip 2 --device cuda
+
+The first argument names the benchmark, the rest are the usual training options.
+"""
+import sys
+import time
+
+import numpy as np
+import torch
+
+from model import Network
+from config import getConfig
+from engine import Engine
+from ema import ModelEMA
+from utils import VATLoss, _disable_tracking_bn_stats, _l2_normalize
+
+
+def timeit(fn, device, repeat=50, warmup=5):
+    """Median wall time of ``fn()`` in milliseconds."""
+    times = []
+    for i in range(warmup + repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1e3
+
+
+@torch.no_grad()
+def naive_ema_update(ema, model, decay):
+    for e, p in zip(ema.parameters(), model.parameters()):
+        e.mul_(decay).add_(p, alpha=1 - decay)
+    for e, b in zip(ema.buffers(), model.buffers()):
+        e.copy_(b)
+
+
+def bench_ema(args, device):
+    model = Network(args).to(device)
+    ema = ModelEMA(model, decay=0.999)
+    num_params = sum(p.numel() for p in model.parameters())
+    num_tensors = len(list(model.parameters())) + len(list(model.buffers()))
+    print(f'EMA update of {args.encoder_name}: {num_params / 1e6:.1f}M parameters in {num_tensors} tensors')
+
+    naive = timeit(lambda: naive_ema_update(ema.module, model, 0.999), device)
+    foreach = timeit(ema.update, device)
+    print(f'Per-parameter loop:{naive:.2f}ms | foreach:{foreach:.2f}ms | Speedup:{naive / foreach:.2f}x')
+
+
+def bench_mpl(args, device):
+    """Steps/sec of the MPL step, sequential and pipelined, on random images."""
+    import mpl
+
+    trainer = mpl.Trainer.__new__(mpl.Trainer)  # the step without the data pipeline
+    trainer.args, trainer.device = args, device
+    trainer.engine = Engine(device, args.amp, 'none', args.micro_batch_size)
+    trainer.teacher, trainer.student = Network(args).to(device).train(), Network(args).to(device).train()
+    trainer.init_setting(args)
+
+    shape = (args.batch_size, 3, args.img_size, args.img_size)
+    images_l, images_us, images_uh = (torch.randn(shape, device=device) for _ in range(3))
+    targets = torch.randint(args.num_classes, (args.batch_size,), device=device)
+
+    def step():
+        trainer.teacher.zero_grad(set_to_none=True)
+        trainer.student.zero_grad(set_to_none=True)
+        trainer.train_step(images_l, targets, images_us, images_uh)
+
+    print(f'MPL step of {args.encoder_name}, batch {args.batch_size}')
+    ms = timeit(step, device, repeat=20, warmup=3)
+    print(f'sequential: {ms:.1f}ms/step | {1e3 / ms:.2f} steps/sec')
+
+    # --mpl_pipeline: the teacher update of step t overlaps the student step t+1
+    pipeline = mpl.TeacherPipeline(trainer, args.teacher_threads)
+    ms = timeit(lambda: trainer.train_step_pipelined(pipeline, images_l, targets, images_us, images_uh),
+                device, repeat=20, warmup=3)
+    pipeline.close()
+    print(f'pipelined ({pipeline.threads} teacher / {max(pipeline.main_threads - pipeline.threads, 1)} student threads): '
+          f'{ms:.1f}ms/step | {1e3 / ms:.2f} steps/sec')
+
+
+def naive_vat_loss(model, x, xi, eps, ip):
+    """VATLoss with the power iteration differentiated through the model's parameters."""
+    with torch.no_grad():
+        pred = torch.softmax(model(x), dim=1)
+    d = _l2_normalize(torch.rand(x.shape).sub(0.5).to(x.device))
+    with _disable_tracking_bn_stats(model):
+        for _ in range(ip):
+            d.requires_grad_()
+            adv_distance = torch.nn.functional.kl_div(torch.log_softmax(model(x + xi * d), dim=1), pred,
+                                                      reduction='batchmean')
+            adv_distance.backward()
+            d = _l2_normalize(d.grad)
+            model.zero_grad()
+        return torch.nn.functional.kl_div(torch.log_softmax(model(x + eps * d), dim=1), pred, reduction='batchmean')
+
+
+def bench_vat(args, device):
+    """Time and peak memory of a VAT loss forward and backward with each ``--vat_hvp`` mode."""
+    model = Network(args).to(device).train()
+    x = torch.randn(args.batch_size, 3, args.img_size, args.img_size, device=device)
+    losses = {'backward': lambda: naive_vat_loss(model, x, args.xi, args.eps, args.ip)}
+    for hvp in ('fd', 'jvp'):
+        losses[hvp] = VATLoss(args.xi, args.eps, args.ip, hvp)
+
+    print(f'VAT loss of {args.encoder_name}, batch {args.batch_size}, ip {args.ip}')
+    for name, loss in losses.items():
+        fn = loss if name == 'backward' else lambda: loss(model, x)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        ms = timeit(lambda: fn().backward(), device, repeat=10, warmup=2)
+        memory = f' | peak {torch.cuda.max_memory_allocated(device) / 2 ** 20:.0f}MiB' if device.type == 'cuda' else ''
+        print(f'{name:>8}: {ms:.1f}ms{memory}')
+
+
+BENCHMARKS = {'ema': bench_ema, 'mpl': bench_mpl, 'vat': bench_vat}
+
+if __name__ == '__main__':
+    name = sys.argv.pop(1) if len(sys.argv) > 1 and not sys.argv[1].startswith('-') else 'ema'
+    if name not in BENCHMARKS:
+        raise SystemExit(f'Unknown benchmark {name!r}, expected one of {", ".join(BENCHMARKS)}')
+    args = getConfig()
+    device = torch.device('cuda' if torch.cuda.is_available() and args.device == 'cuda' else 'cpu')
+    BENCHMARKS[name](args, device)
@@ -0,0 +1,189 @@
+import os
+import copy
+import queue
+import random
+import atexit
+import threading
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from distributed import is_distributed, is_main_process, get_rank, get_world_size
+
+
+def snapshot(obj):
+    """Copy of a (nested) state dict whose tensors live in CPU memory and no longer alias the
+    training state. Device tensors are copied asynchronously into pinned memory, with a single
+    synchronization at the end.
+    """
+    cuda = []
+
+    def copy_to_cpu(x):
+        if isinstance(x, torch.Tensor):
+            if x.is_cuda:
+                out = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+                out.copy_(x.detach(), non_blocking=True)
+                cuda.append(out)
+                return out
+            return x.detach().clone()
+        if isinstance(x, dict):
+            return type(x)((k, copy_to_cpu(v)) for k, v in x.items())
+        if isinstance(x, (list, tuple)):
+            return type(x)(copy_to_cpu(v) for v in x)
+        return copy.deepcopy(x)
+
+    obj = copy_to_cpu(obj)
+    if cuda:
+        torch.cuda.synchronize()
+    return obj
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread so that training only pays for the CPU snapshot.
+
+    ``save`` snapshots the state and queues it; the writer thread serializes it to a temporary
+    file in the target directory, fsyncs it and renames it over ``path``, so a checkpoint on disk
+    is always complete. At most ``max_pending`` snapshots are held at once (``save`` blocks when
+    the queue is full), which bounds the extra host memory. Only rank 0 writes. Pending writes
+    are flushed at interpreter exit; call ``wait`` before reading a checkpoint back.
+    """
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, obj, path):
+        if not is_main_process():
+            return
+        self._raise()
+        self.queue.put((snapshot(obj), path))
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk."""
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                tmp = os.path.join(os.path.dirname(path) or '.', f'.{os.path.basename(path)}.tmp')
+                with open(tmp, 'wb') as f:
+                    torch.save(obj, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+def rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def seek_loader(loader, epoch, batches=0):
+    """Makes the next iteration of ``loader`` (a DataLoader, possibly behind a DevicePrefetcher)
+    produce ``epoch``'s order starting at batch ``batches``.
+
+    Applies to loaders whose order is a function of the epoch, i.e. a ``ShardSampler`` or a
+    ``ShardStream`` dataset; other loaders are left as they are. The loader's generator, which
+    seeds the workers, is reseeded from the epoch as well.
+    """
+    loader = getattr(loader, 'loader', loader)
+    for source in (loader.dataset, loader.sampler):
+        if hasattr(source, 'set_epoch'):
+            source.set_epoch(epoch)
+            if loader.generator is not None:
+                loader.generator.manual_seed(source.seed * 100003 + epoch)
+            if batches:
+                source.resume(batches, loader.batch_size)
+
+
+class RunState(object):
+    """Full training state in ``<save_path>/last.pth``, from which ``--resume`` continues a run.
+
+    A run goes through ``phases`` in order (e.g. pre-training then finetuning). Each save records
+    the phase, the epoch, the number of batches done in it (0 at epoch boundaries), the
+    ``state_dict`` of every object passed in (models, optimizers, schedulers, loss scaler,
+    early stopping, the metrics of a partial epoch, ...) and the RNG states of every rank.
+    Together with the epoch-seeded samplers this lets a restarted job pick up at the same batch.
+    """
+    def __init__(self, args, writer, phases):
+        self.path = os.path.join(args.save_path, 'last.pth')
+        self.interval = args.save_interval
+        self.writer = writer
+        self.phases = list(phases)
+        self.loaded = None
+        self.pending = {}
+        if args.resume and os.path.exists(self.path):
+            self.loaded = torch.load(self.path, map_location='cpu', weights_only=False)
+            print(f"Resuming from {self.path}: phase {self.loaded['phase']}, epoch {self.loaded['epoch']}, "
+                  f"step {self.loaded['step']}")
+
+    def done(self, phase):
+        """Whether the run being resumed is already past ``phase``."""
+        return self.loaded is not None and self.phases.index(self.loaded['phase']) > self.phases.index(phase)
+
+    def restore(self, phase, objects):
+        """Loads ``objects`` and the RNG states if the run is resumed in ``phase``.
+
+        Returns the epoch and the step within it to continue from, ``(0, 0)`` for a fresh phase.
+        Saved objects that are not in ``objects`` are kept for ``load``.
+        """
+        state = self.loaded
+        if state is None or state['phase'] != phase:
+            return 0, 0
+        self.loaded = None
+        for name, obj_state in state['objects'].items():
+            if name in objects:
+                objects[name].load_state_dict(obj_state)
+            else:
+                self.pending[name] = obj_state
+        rng = state['rng']
+        set_rng_state(rng[get_rank()] if len(rng) == get_world_size() else rng[0])
+        return state['epoch'], state['step']
+
+    def load(self, name, obj):
+        """Loads a saved object that only exists later, such as the metrics of the resumed epoch."""
+        if name in self.pending:
+            obj.load_state_dict(self.pending.pop(name))
+
+    def due(self, step):
+        return self.interval > 0 and step % self.interval == 0
+
+    def save(self, phase, epoch, step, objects):
+        """Checkpoints ``objects`` at batch ``step`` of ``epoch``; collective under a process group."""
+        rng = [rng_state()]
+        if is_distributed():
+            rng = [None] * get_world_size()
+            dist.all_gather_object(rng, rng_state())
+        self.writer.save({'phase': phase, 'epoch': epoch, 'step': step, 'rng': rng,
+                          'objects': {name: obj.state_dict() for name, obj in objects.items()}}, self.path)
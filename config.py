@@ -8,6 +8,13 @@ def getConfig():
     parser.add_argument('--file_name', type=str, default='train_df.csv')
     parser.add_argument('--save_path', type=str, default='results/')
 
+    # Dataset settings
+    parser.add_argument('--num_label', type=int, default=400, help='Labeled samples per class')
+    parser.add_argument('--num_valid', type=int, default=500, help='Validation samples per class')
+    parser.add_argument('--split_seed', type=int, default=None)
+    parser.add_argument('--unlabel_shards', type=str, default=None, help='Shard directory to stream the unlabeled pool from')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000, help='Samples held for shuffling the shard stream')
+
     # Model parameter settings
     parser.add_argument('--encoder_name', type=str, default='resnet50')
     parser.add_argument('--num_classes', type=int, default=10)
@@ -19,6 +26,8 @@ def getConfig():
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--img_size', type=int, default=32)
     parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--micro_batch_size', type=int, default=0,
+                        help='Split each batch into micro-batches of at least 2 samples and accumulate gradients (0: no splitting)')
     # parser.add_argument('--optimizer', type=str, default='Lamb')
     parser.add_argument('--lr', type=float, default=1e-3)
     parser.add_argument('--weight_decay', type=float, default=1e-3)
@@ -40,24 +49,53 @@ def getConfig():
 
     ## etc.
     parser.add_argument('--patience', type=int, default=10, help='Early Stopping')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from <save_path>/last.pth')
+    parser.add_argument('--save_interval', type=int, default=0,
+                        help='Also write last.pth every N steps within an epoch (0: only at epoch ends)')
     parser.add_argument('--use_tensorboard', type=bool, default=True)
     parser.add_argument('--label_smoothing', type=float, default=0)
+    parser.add_argument('--ema_decay', type=float, default=0,
+                        help='Keep an EMA of the weights for validation and the best checkpoint (0: off, e.g. 0.999)')
+    parser.add_argument('--ema_every', type=int, default=1, help='Update the EMA every N steps')
+    parser.add_argument('--ema_buffers', type=str, default='copy', choices=['copy', 'average'],
+                        help='Copy the BN running statistics into the EMA or average them like the weights')
 
     parser.add_argument('--method', type=str, default=None)
     # Semi-supervised Learning
     parser.add_argument('--threshold', type=float, default=0.8)
     parser.add_argument('--lambda_u', type=float, default=1)
     parser.add_argument('--temperature', type=float, default=1)
+    ## FixMatch
+    parser.add_argument('--weak_forward', type=str, default='joint', choices=['joint', 'nograd', 'gated'],
+                        help='joint: one forward over labeled, weak and strong views; '
+                             'nograd: weak-view pseudo labels from a separate forward without a graph; '
+                             'gated: nograd, and only the strong views above the threshold are forwarded')
+    parser.add_argument('--gate_buckets', type=int, default=4,
+                        help='Number of strong-batch sizes the gated selection is padded to')
+    parser.add_argument('--ema_pseudo_label', action='store_true',
+                        help='Take the weak-view pseudo labels from the EMA model (nograd and gated modes)')
+    parser.add_argument('--weak_bn', type=str, default='train', choices=['train', 'frozen', 'eval'],
+                        help='BatchNorm in the nograd weak forward: batch stats updating the running stats (train), '
+                             'batch stats without updating them (frozen) or the running stats (eval)')
 
     ## Noisy Student
     parser.add_argument('--steps', type=int, default=5)
 
     ## Meta Pseudo Labels
+    parser.add_argument('--mpl_pipeline', action='store_true',
+                        help='Train the teacher on its own thread one step behind the student, '
+                             'so that its update overlaps the next student step (pseudo labels one update stale)')
+    parser.add_argument('--teacher_threads', type=int, default=0,
+                        help='CPU intra-op threads of the pipelined teacher (0: half of them)')
 
     ## Virtual Adversarial Training
     parser.add_argument('--xi', type=float, default=10.0)
     parser.add_argument('--eps', type=float, default=1.0)
-    parser.add_argument('--ip', type=float, default=1)
+    parser.add_argument('--ip', type=int, default=1)
+    parser.add_argument('--vat_hvp', type=str, default='fd', choices=['fd', 'jvp'],
+                        help='Hessian-vector product of the power iteration: KL gradient at xi*d (fd) '
+                             'or the exact product at the clean input via jvp/vjp (jvp)')
 
     # Self-supervised Learning
     parser.add_argument('--feature_dim', type=int, default=0)
@@ -66,7 +104,20 @@ def getConfig():
     # Hardware settings
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--device_aug', action='store_true',
+                        help='Workers emit uint8 images; augmentation and normalization run on the device')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='Mixed precision autocast; fp16 needs CUDA, bf16 also runs on CPU')
+    parser.add_argument('--compile', type=str, default='none',
+                        choices=['none', 'default', 'reduce-overhead', 'max-autotune'],
+                        help='torch.compile mode for the models and training steps')
+    parser.add_argument('--dist_backend', type=str, default='gloo',
+                        help='Process group backend when launched with torchrun (gloo also runs on CPU)')
     parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log_interval', type=int, default=0,
+                        help='Show running train metrics every N steps (0: only once per epoch)')
+    parser.add_argument('--time_stages', action='store_true',
+                        help='Time data wait, H2D, forward, backward and optimizer per step (TensorBoard + timing.jsonl)')
     args = parser.parse_args()
 
     return args
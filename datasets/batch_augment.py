@@ -0,0 +1,188 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from datasets.loader_cifar import get_augmentation
+from datasets.multi_view import MultiViewDataset
+from datasets.prefetch import DevicePrefetcher
+from datasets.streaming import ShardStream
+
+
+class BatchAugmentation(nn.Module):
+    """Batched counterpart of ``get_augmentation`` that runs on whole uint8 batches.
+
+    Every sample draws its own random parameters. All geometric ops (rotations and flips)
+    are composed into a single affine grid per sample and applied with one ``grid_sample``;
+    colour ops are plain tensor math on the batch.
+    Args:
+        img_size (int): Output resolution.
+        rotations (list): ``(min_deg, max_deg)`` ranges, one random rotation per entry,
+            applied in order. Angles are counter-clockwise, as in ``RandomRotation``; ranges taken
+            from ``RandomAffine``, which rotates clockwise, are negated.
+        hflip (float): Probability of a horizontal flip.
+        vflip (float): Probability of a vertical flip.
+        brightness, contrast, saturation (float): ``ColorJitter`` strengths (0 disables).
+        invert (float): Probability of inverting the colours.
+        mean, std (list): Normalization parameters.
+    """
+    def __init__(self, img_size=32, rotations=(), hflip=0., vflip=0.,
+                 brightness=0., contrast=0., saturation=0., invert=0.,
+                 mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)):
+        super(BatchAugmentation, self).__init__()
+        self.img_size = img_size
+        self.rotations = [tuple(r) for r in rotations]
+        self.hflip = hflip
+        self.vflip = vflip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.invert = invert
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+    def forward(self, images, generator=None):
+        """
+        Args:
+            images (Tensor): uint8 (or [0, 1] float) batch of shape (B, C, H, W).
+        Returns:
+            Tensor: float32 normalized batch of shape (B, C, img_size, img_size).
+        """
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        else:
+            images = images.float()
+        mean, std = self.mean.to(images.device), self.std.to(images.device)
+
+        images = self._geometric(images, generator)
+        images = self._color(images, generator)
+
+        if images.shape[-2:] != (self.img_size, self.img_size):
+            images = F.interpolate(images, size=(self.img_size, self.img_size), mode='bilinear',
+                                   align_corners=False, antialias=True)
+        return images.sub_(mean).div_(std)
+
+    def _uniform(self, low, high, batch_size, device, generator):
+        return torch.rand(batch_size, device=device, generator=generator) * (high - low) + low
+
+    def _bernoulli(self, p, batch_size, device, generator):
+        return torch.rand(batch_size, device=device, generator=generator) < p
+
+    def _geometric(self, images, generator):
+        if not self.rotations and self.hflip == 0 and self.vflip == 0:
+            return images
+        B, _, H, W = images.shape
+        device = images.device
+
+        # Inverse (output -> input) mapping in centred pixel coordinates. Ops are applied
+        # in order, so the inverse of op n is multiplied on the right.
+        inv = torch.eye(2, device=device).expand(B, 2, 2)
+        for low, high in self.rotations:
+            angle = self._uniform(low, high, B, device, generator) * (math.pi / 180)
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            # counter-clockwise rotation on screen (y axis pointing down), as in TF.rotate / RandomRotation;
+            # TF.affine / RandomAffine rotate clockwise, i.e. by the negated angle
+            rot_inv = torch.stack([torch.stack([cos, -sin], -1), torch.stack([sin, cos], -1)], 1)
+            inv = inv @ rot_inv
+        for p, axis in ((self.hflip, 0), (self.vflip, 1)):
+            if p > 0:
+                sign = 1 - 2 * self._bernoulli(p, B, device, generator).float()
+                flip = torch.diag_embed(torch.ones(B, 2, device=device))
+                flip[:, axis, axis] = sign
+                inv = inv @ flip
+
+        # to normalized coordinates of affine_grid (align_corners=False)
+        scale = torch.tensor([W / 2, H / 2], device=device)
+        theta = inv * scale.view(1, 1, 2) / scale.view(1, 2, 1)
+        theta = torch.cat([theta, torch.zeros(B, 2, 1, device=device)], dim=2)
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        # nearest + zero fill matches the torchvision defaults
+        return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def _color(self, images, generator):
+        B = images.shape[0]
+        device = images.device
+        shape = (B, 1, 1, 1)
+        if self.brightness > 0:
+            factor = self._uniform(max(0., 1 - self.brightness), 1 + self.brightness, B, device, generator)
+            images = (images * factor.view(shape)).clamp_(0, 1)
+        if self.contrast > 0:
+            factor = self._uniform(max(0., 1 - self.contrast), 1 + self.contrast, B, device, generator)
+            gray_mean = _grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+            images = (factor.view(shape) * images + (1 - factor.view(shape)) * gray_mean).clamp_(0, 1)
+        if self.saturation > 0:
+            factor = self._uniform(max(0., 1 - self.saturation), 1 + self.saturation, B, device, generator)
+            images = (factor.view(shape) * images + (1 - factor.view(shape)) * _grayscale(images)).clamp_(0, 1)
+        if self.invert > 0:
+            mask = self._bernoulli(self.invert, B, device, generator).view(shape)
+            images = torch.where(mask, 1 - images, images)
+        return images
+
+
+def _grayscale(images):
+    r, g, b = images.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def get_batch_augmentation(img_size=32, ver=1):
+    """Same versions as ``get_augmentation``, applied to whole batches on the training device."""
+    if ver == 1:
+        transform = BatchAugmentation(img_size)
+    elif ver == 2: #weak augmentation
+        # RandomAffine(degrees=(10, 30)) rotates clockwise
+        transform = BatchAugmentation(img_size, rotations=[(-30, -10)], hflip=0.5, vflip=0.5)
+    elif ver == 3: #Hard augmentation
+        # ColorJitter() with default arguments is the identity, so no jitter here either
+        transform = BatchAugmentation(img_size, rotations=[(-180, 180), (-30, 30)], hflip=0.5, vflip=0.5,
+                                      invert=0.5)
+    elif ver == 4:
+        transform = BatchAugmentation(img_size, hflip=1, vflip=1)
+
+    return transform
+
+
+class DeviceViews(object):
+    """Batch transform making the views of a batch of uint8 images already on the device: every
+    augmentation in ``augmentations`` (float conversion and normalization included) runs there.
+    Maps ``(images, *rest)`` to ``(view_1, ..., view_K, *rest)``.
+    """
+    def __init__(self, augmentations, device):
+        self.augmentations = [aug.to(device) for aug in augmentations]
+
+    def __call__(self, batch):
+        images, *rest = batch
+        return tuple(aug(images) for aug in self.augmentations) + tuple(rest)
+
+
+def get_views(dataset, vers, args):
+    """Wraps ``dataset`` (returning untransformed samples) to emit one view per entry of ``vers``.
+
+    With ``--device_aug`` the dataset only emits a single uint8 tensor per sample and the
+    views are made by ``to_device_views`` on the training device.
+    """
+    return MultiViewDataset(dataset, view_transforms(vers, args))
+
+
+def view_transforms(vers, args):
+    """Per-sample transforms making the views of ``vers`` (a single uint8 one with ``--device_aug``)."""
+    if args.device_aug:
+        return [get_augmentation(ver=0)]
+    return [get_augmentation(ver=ver) for ver in vers]
+
+
+def get_unlabel_views(source, vers, args):
+    """``get_views`` of the unlabeled split, streamed from ``--unlabel_shards`` when it is given."""
+    if args.unlabel_shards:
+        return ShardStream(args.unlabel_shards, view_transforms(vers, args), shuffle_buffer=args.shuffle_buffer,
+                           seed=args.seed, batch_size=args.batch_size)
+    return get_views(source.split('unlabel'), vers, args)
+
+
+def to_device_views(loader, vers, args, device, timer=None):
+    """Counterpart of ``get_views`` applied to the DataLoader: batches are prefetched to ``device``
+    and, with ``--device_aug``, their views are made there."""
+    transform = None
+    if args.device_aug:
+        transform = DeviceViews([get_batch_augmentation(ver=ver) for ver in vers], device)
+    return DevicePrefetcher(loader, device, transform, timer)
@@ -10,6 +10,8 @@ from torchvision import transforms
 import torchvision.transforms.functional as TF
 from torch.utils.data import Dataset, DataLoader
 
+from datasets.shards import load_meta, load_shard_index, open_shard, read_image
+
 # 테스트셋도 레이블 알고있다고 가정
 class Custom_Dataset(Dataset):
     def __init__(self, df, transform=None, two_transform=None):
@@ -38,6 +40,62 @@ class Custom_Dataset(Dataset):
     def __len__(self):
         return len(self.id)
 
+class Shard_Dataset(Dataset):
+    """``Custom_Dataset`` read from shards written by ``datasets.shards.pack_shards``.
+
+    Images are pre-decoded uint8 and read through memory maps, so no file is opened or
+    decoded per sample. Returns the same float [0, 1] CHW tensors as ``Custom_Dataset``,
+    or uint8 tensors with ``uint8=True``.
+    """
+    def __init__(self, shard_dir, transform=None, two_transform=None, uint8=False):
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.two_transform = two_transform
+        self.uint8 = uint8
+
+        meta = load_meta(shard_dir)
+        self.names = [s['name'] for s in meta['shards']]
+        index, target, shard_id = [], [], []
+        for i, name in enumerate(self.names):
+            idx, labels = load_shard_index(shard_dir, name)
+            index.append(idx)
+            target.append(labels)
+            shard_id.append(np.full(len(idx), i, dtype=np.int64))
+        self.index = np.concatenate(index)
+        self.target = np.concatenate(target)
+        self.shard_id = np.concatenate(shard_id)
+        self.shards = {}
+
+        print(f'Dataset size:{len(self.index)}')
+
+    def __getitem__(self, idx):
+        shard_id = self.shard_id[idx]
+        if shard_id not in self.shards:
+            self.shards[shard_id] = open_shard(self.shard_dir, self.names[shard_id])
+        image = torch.from_numpy(np.array(read_image(self.shards[shard_id], self.index[idx]).transpose(2, 0, 1)))
+        if not self.uint8:
+            image = image.float().div_(255)
+        target = self.target[idx]
+
+        img = image
+        if self.transform is not None:
+            img = self.transform(image)
+
+        if self.two_transform is not None:
+            img2 = self.two_transform(image)
+            return img, img2, target
+
+        return img, target
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in each worker
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
 class GammaTransform:
     """Rotate by one of the given angles."""
 
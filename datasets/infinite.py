@@ -0,0 +1,74 @@
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler
+
+
+class InfiniteBatchSampler(Sampler):
+    """Endless stream of index batches: every pass over the dataset is a fresh permutation,
+    drawn from ``(seed, pass)``, with the incomplete last batch of each pass dropped.
+    Under a process group each rank takes an equal strided slice of every permutation.
+    ``len()`` is the number of batches per pass.
+    """
+    def __init__(self, num_samples, batch_size, seed=0, start=0):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.seed = seed
+        self.start = start
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+
+    def __len__(self):
+        return self.num_samples // self.world_size // self.batch_size
+
+    def __iter__(self):
+        passes, offset = divmod(self.start, len(self))
+        while True:
+            g = torch.Generator()
+            g.manual_seed(self.seed * 100003 + passes)
+            perm = torch.randperm(self.num_samples, generator=g)[self.rank::self.world_size]
+            for i in range(offset, len(self)):
+                yield perm[i * self.batch_size:(i + 1) * self.batch_size].tolist()
+            passes, offset = passes + 1, 0
+
+
+class InfiniteLoader(object):
+    """Labeled stream for semi-supervised loops that never runs out.
+
+    A single DataLoader iterator is kept for the whole run, so its workers are started once,
+    keep prefetching across passes and are never respawned. ``on_wrap`` is called right before
+    the first batch of every pass after the first one reaches the loop (where the old loops
+    restarted the iterator). Batches are counted as they are handed to the loop by ``handed()``,
+    which a DevicePrefetcher calls; on CUDA it fetches one batch ahead, so fetching is too early.
+    """
+    def __init__(self, dataset, batch_size, num_workers=0, pin_memory=False, seed=0, on_wrap=None):
+        self.batch_sampler = InfiniteBatchSampler(len(dataset), batch_size, seed=seed)
+        # own generator: iter(loader) draws the worker base seed from it, not from the global RNG
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        self.loader = DataLoader(dataset, batch_sampler=self.batch_sampler, num_workers=num_workers,
+                                 pin_memory=pin_memory, generator=generator)
+        self.on_wrap = on_wrap
+        self.consumed = 0
+        self._iterator = None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def resume(self, consumed):
+        """Continues the stream after its first ``consumed`` batches; call before iterating."""
+        self.batch_sampler.start = consumed
+        self.consumed = consumed
+
+    def handed(self):
+        """Counts the next batch as handed to the loop, calling ``on_wrap`` if it starts a new pass."""
+        if self.consumed and self.consumed % len(self) == 0 and self.on_wrap is not None:
+            self.on_wrap()
+        self.consumed += 1
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.loader)
+        while True:
+            yield next(self._iterator)
@@ -16,22 +16,24 @@ from torchvision import transforms
 from torchvision.datasets.utils import download_url, check_integrity
 
 
-class CIFAR10(data.Dataset):
-    """`CIFAR10 <https://www.cs.toronto.edu/~kriz/cifar.html>`_ Dataset.
+class CIFAR10Source(object):
+    """Memory-mapped CIFAR10 arrays and split manifest, loaded once and shared by every split.
     Args:
         root (string): Root directory of dataset where directory
             ``cifar-10-batches-py`` exists.
-        train (bool, optional): If True, creates dataset from training set, otherwise
-            creates from test set.
-        transform (callable, optional): A function/transform that  takes in an PIL image
-            and returns a transformed version. E.g, ``transforms.RandomCrop``
-        target_transform (callable, optional): A function/transform that takes in the
-            target and transforms it.
         download (bool, optional): If true, downloads the dataset from the internet and
             puts it in root directory. If dataset is already downloaded, it is not
             downloaded again.
+        boundary (int, optional): Rotates the training set by ``5000 * boundary`` samples
+            before splitting.
+        num_valid (int, optional): Number of validation samples per class.
+        num_label (int, optional): Number of labeled samples per class, e.g. 4/25/400
+            for the 40/250/4000-label settings.
+        seed (int, optional): If given, samples are shuffled before being assigned to
+            the splits. Otherwise they are assigned in (boundary-rotated) file order.
     """
     base_folder = 'cifar-10-batches-py'
+    memmap_folder = 'cifar-10-memmap'
     url = "https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz"
     filename = "cifar-10-python.tar.gz"
     tgz_md5 = 'c58f30108f718f92721af3b95e74349a'
@@ -47,202 +49,108 @@ class CIFAR10(data.Dataset):
         ['test_batch', '40351d587109b95175f43aff81a1287e'],
     ]
     nclass = 10
-    split_list = ['label', 'unlabel', 'valid', 'test', 'pseudo']
 
-    def __init__(self, root, split='train',
-                 transform=None, target_transform=None,
-                 download=False, boundary=0, indices=None, labels=None, two_transform=None):
+    def __init__(self, root, download=False, boundary=0, num_valid=500, num_label=400, seed=None):
         self.root = os.path.expanduser(root)
-        self.transform = transform
-        self.target_transform = target_transform
-        self.split = split
-        self.indices = indices
-        self.labels = labels
-        self.two_transform = two_transform
+        self.boundary = boundary
+        self.num_valid = num_valid
+        self.num_label = num_label
+        self.seed = seed
         assert (boundary < 10)
         print("Boundary: ", boundary)
-        if self.split not in self.split_list:
-            raise ValueError('Wrong split entered! Please use split="train" '
-                             'or split="extra" or split="test"')
 
-        if download:
-            self.download()
-
-        if not self._check_integrity():
-            raise RuntimeError('Dataset not found or corrupted.' +
-                               ' You can use download=True to download it')
-
-        # now load the picked numpy arrays
-        if self.split == 'label' or self.split == 'unlabel' or self.split == 'valid' or self.split == 'pseudo':
-            self.train_data = []
-            self.train_labels = []
-            for fentry in self.train_list:
-                f = fentry[0]
-                file = os.path.join(self.root, self.base_folder, f)
-                fo = open(file, 'rb')
-                if sys.version_info[0] == 2:
-                    entry = pickle.load(fo)
-                else:
-                    entry = pickle.load(fo, encoding='latin1')
-                self.train_data.append(entry['data'])
-                if 'labels' in entry:
-                    self.train_labels += entry['labels']
-                else:
-                    self.train_labels += entry['fine_labels']
-                fo.close()
-
-            self.train_data = np.concatenate(self.train_data)
-            if boundary != 0:
-                bidx = 5000 * boundary
-                self.train_data = [self.train_data[bidx:], self.train_data[:bidx]]
-                self.train_data = np.concatenate(self.train_data)
-                self.train_labels = [self.train_labels[bidx:], self.train_labels[:bidx]]
-                self.train_labels = np.concatenate(self.train_labels)
-
-            train_datau = []
-            train_labelsu = []
-            train_data1 = []
-            train_labels1 = []
-            valid_data1 = []
-            valid_labels1 = []
-            num_labels_valid = [0 for _ in range(self.nclass)]
-            num_labels_train = [0 for _ in range(self.nclass)]
-            for i in range(self.train_data.shape[0]):
-                tmp_label = self.train_labels[i]
-                if num_labels_valid[tmp_label] < 500:
-                    valid_data1.append(self.train_data[i])
-                    valid_labels1.append(self.train_labels[i])
-                    num_labels_valid[tmp_label] += 1
-                elif num_labels_train[tmp_label] < 400:
-                    train_data1.append(self.train_data[i])
-                    train_labels1.append(self.train_labels[i])
-                    num_labels_train[tmp_label] += 1
-
-                    # train_datau.append(self.train_data[i])
-                    # train_labelsu.append(self.train_labels[i])
-                else:
-                    train_datau.append(self.train_data[i])
-                    train_labelsu.append(self.train_labels[i])
-
-            if self.split == 'label':
-                self.train_data = train_data1
-                self.train_labels = train_labels1
-
-                self.train_data = np.concatenate(self.train_data)
-                self.train_data = self.train_data.reshape((len(train_data1), 3, 32, 32))
-                self.train_data = self.train_data.transpose((0, 2, 3, 1))  # convert to HWC
-
-                num_tr = self.train_data.shape[0]
-                # print(self.train_data1[:1,:1,:5,:5])
-                # print(self.train_labels1[:10])
-                # print(self.train_data[:1,:1,:5,:5])
-                # print(self.train_labels[:10])
-                print('Label: ', num_tr)  # label
-
-                # self.midx=0
-                # self.idx_offset = num_tr_ul - (num_tr_ul//num_tr) * num_tr
-                # print('Offset: :',self.idx_offset)
-
-            elif self.split == 'unlabel':
-                self.train_data_ul = train_datau
-                self.train_labels_ul = train_labelsu
-
-                self.train_data_ul = np.concatenate(self.train_data_ul)
-                self.train_data_ul = self.train_data_ul.reshape((len(train_datau), 3, 32, 32))
-                self.train_data_ul = self.train_data_ul.transpose((0, 2, 3, 1))  # convert to HWC
-
-                num_tr_ul = self.train_data_ul.shape[0]
-                print('Unlabel: ', num_tr_ul)  # unlabel
-
-            elif self.split == 'valid':
-                self.valid_data = valid_data1
-                self.valid_labels = valid_labels1
-
-                self.valid_data = np.concatenate(self.valid_data)
-                self.valid_data = self.valid_data.reshape((len(valid_data1), 3, 32, 32))
-                self.valid_data = self.valid_data.transpose((0, 2, 3, 1))  # convert to HWC
-
-                num_val = self.valid_data.shape[0]
-                print('Valid: ', num_val)  # valid
-                # print(self.valid_data[:1,:1,:5,:5])
-                # print(self.valid_labels[:10])
-
-            elif self.split == 'pseudo':
-                self.train_data_ul = list(np.array(train_datau)[self.indices])
-                self.train_labels_ul = self.labels
-
-                self.train_data_ul = np.concatenate(self.train_data_ul)
-
-                self.train_data_ul = self.train_data_ul.reshape((len(self.indices), 3, 32, 32))
-                self.train_data_ul = self.train_data_ul.transpose((0, 2, 3, 1))  # convert to HWC
-
-                num_tr_ul = self.train_data_ul.shape[0]
-                print('Pseudo: ', num_tr_ul)
-
-        elif self.split == 'test':
-            f = self.test_list[0][0]
+        if not self._check_memmap():
+            if download:
+                self.download()
+
+            if not self._check_integrity():
+                raise RuntimeError('Dataset not found or corrupted.' +
+                                   ' You can use download=True to download it')
+
+        # uint8 HWC arrays are memory-mapped so every split and every worker shares the same pages
+        self._open()
+        self.manifest = self._load_manifest()
+        self.manifest['test'] = np.arange(len(self.test_targets))
+
+    def split(self, split, transform=None, target_transform=None, indices=None, labels=None, two_transform=None,
+              confidences=None):
+        """Returns a ``CIFAR10`` view of ``split`` backed by this source."""
+        return CIFAR10(self.root, split=split, transform=transform, target_transform=target_transform,
+                       indices=indices, labels=labels, two_transform=two_transform, confidences=confidences,
+                       source=self)
+
+    def __getstate__(self):
+        # Memory maps are reopened by each DataLoader worker instead of being pickled by value
+        state = self.__dict__.copy()
+        for name in ('train_data', 'train_targets', 'test_data', 'test_targets'):
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _open(self):
+        for name in ('train', 'test'):
+            if not self._check_memmap(name):
+                self._build_memmap(name)
+            setattr(self, name + '_data', np.load(self._memmap_path(name + '_data'), mmap_mode='r'))
+            setattr(self, name + '_targets', np.load(self._memmap_path(name + '_labels'), mmap_mode='r'))
+
+    def _load_manifest(self):
+        """Returns the valid/label/unlabel index arrays, computing and caching them on first use."""
+        path = self._memmap_path('split_b{}_v{}_l{}_s{}'.format(self.boundary, self.num_valid, self.num_label,
+                                                                self.seed), ext='.npz')
+        if not os.path.exists(path):
+            manifest = split_indices(np.asarray(self.train_targets), self.nclass, boundary=self.boundary,
+                                     num_valid=self.num_valid, num_label=self.num_label, seed=self.seed)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as fo:
+                np.savez(fo, **manifest)
+            os.replace(tmp_path, path)
+        with np.load(path) as f:
+            return {k: f[k] for k in f.files}
+
+    def _memmap_path(self, name, ext='.npy'):
+        return os.path.join(self.root, self.memmap_folder, name + ext)
+
+    def _check_memmap(self, name=None):
+        names = ['train', 'test'] if name is None else [name]
+        return all(os.path.exists(self._memmap_path(n + '_labels')) for n in names)
+
+    def _build_memmap(self, name):
+        """Converts the pickled batches of ``name`` ('train' or 'test') into a uint8 NHWC
+        array and an int64 label array stored as .npy files under ``root``."""
+        file_list = self.test_list if name == 'test' else self.train_list
+        data = []
+        labels = []
+        for fentry in file_list:
+            f = fentry[0]
             file = os.path.join(self.root, self.base_folder, f)
             fo = open(file, 'rb')
             if sys.version_info[0] == 2:
                 entry = pickle.load(fo)
             else:
                 entry = pickle.load(fo, encoding='latin1')
-            self.test_data = entry['data']
+            data.append(entry['data'])
             if 'labels' in entry:
-                self.test_labels = entry['labels']
+                labels += entry['labels']
             else:
-                self.test_labels = entry['fine_labels']
+                labels += entry['fine_labels']
             fo.close()
-            self.test_data = self.test_data.reshape((10000, 3, 32, 32))
-            self.test_data = self.test_data.transpose((0, 2, 3, 1))  # convert to HWC
 
-    def __getitem__(self, index):
-        """
-        Args:
-            index (int): Index
-        Returns:
-            tuple: (image, target) where target is index of the target class.
-        """
-        if self.split == 'label':
-            img, target = self.train_data[index], self.train_labels[index]
-        elif self.split == 'unlabel':
-            img, target = self.train_data_ul[index], self.train_labels_ul[index]
-        elif self.split == 'valid':
-            img, target = self.valid_data[index], self.valid_labels[index]
-        elif self.split == 'test':
-            img, target = self.test_data[index], self.test_labels[index]
-        elif self.split == 'pseudo':
-            img, target = self.train_data_ul[index], self.train_labels_ul[index]
-
-        # doing this so that it is consistent with all other datasets
-        # to return a PIL Image
-        img1 = np.copy(img)
-        img = Image.fromarray(img)
-        #img1 = Image.fromarray(img1)
+        data = np.concatenate(data).reshape((-1, 3, 32, 32))
+        data = np.ascontiguousarray(data.transpose((0, 2, 3, 1)))  # convert to HWC
+        labels = np.array(labels, dtype=np.int64)
 
-        if self.transform is not None:
-            img = self.transform(img)
-            if self.two_transform is not None:
-                img1 = Image.fromarray(img1)
-                img1 = self.transform(img1)
-                return img, img1, target
-
-        if self.target_transform is not None:
-            target = self.target_transform(target)
-
-        return img, target
-
-    def __len__(self):
-        if self.split == 'label':
-            return len(self.train_data)
-        elif self.split == 'unlabel':
-            return len(self.train_data_ul)
-        elif self.split == 'valid':
-            return len(self.valid_data)
-        elif self.split == 'test':
-            return len(self.test_data)
-        elif self.split == 'pseudo':
-            return len(self.train_data_ul)
+        os.makedirs(os.path.join(self.root, self.memmap_folder), exist_ok=True)
+        # labels are written last: their presence marks a complete conversion
+        for suffix, array in (('_data', data), ('_labels', labels)):
+            path = self._memmap_path(name + suffix)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as fo:
+                np.save(fo, array)
+            os.replace(tmp_path, path)
 
     def _check_integrity(self):
         root = self.root
@@ -271,11 +179,120 @@ class CIFAR10(data.Dataset):
         tar.close()
         os.chdir(cwd)
 
+
+_sources = {}
+
+
+class CIFAR10(data.Dataset):
+    """`CIFAR10 <https://www.cs.toronto.edu/~kriz/cifar.html>`_ Dataset.
+    A lightweight view (index array plus transforms) over a shared ``CIFAR10Source``.
+    Args:
+        root (string): Root directory of dataset where directory
+            ``cifar-10-batches-py`` exists.
+        split (string): One of ``split_list``.
+        transform (callable, optional): A function/transform that  takes in an PIL image
+            and returns a transformed version. E.g, ``transforms.RandomCrop``
+        target_transform (callable, optional): A function/transform that takes in the
+            target and transforms it.
+        indices (array, optional): For ``split='pseudo'``, positions in the unlabel split of the
+            selected samples.
+        labels (array, optional): For ``split='pseudo'``, pseudo labels of the selected samples.
+        confidences (array, optional): For ``split='pseudo'``, teacher confidence of each pseudo label.
+        source (CIFAR10Source, optional): Source to read from. When not given, one is built
+            from ``download``, ``boundary``, ``num_valid``, ``num_label`` and ``seed`` and
+            cached for the lifetime of the process.
+    """
+    nclass = 10
+    split_list = ['label', 'unlabel', 'valid', 'test', 'pseudo']
+
+    def __init__(self, root, split='train',
+                 transform=None, target_transform=None,
+                 download=False, boundary=0, indices=None, labels=None, two_transform=None,
+                 num_valid=500, num_label=400, seed=None, confidences=None, source=None):
+        self.root = os.path.expanduser(root)
+        self.transform = transform
+        self.target_transform = target_transform
+        self.split = split
+        self.indices = indices
+        self.labels = labels
+        self.confidences = confidences
+        self.two_transform = two_transform
+        if self.split not in self.split_list:
+            raise ValueError('Wrong split entered! Please use split="train" '
+                             'or split="extra" or split="test"')
+
+        if source is None:
+            key = (self.root, boundary, num_valid, num_label, seed)
+            if key not in _sources:
+                _sources[key] = CIFAR10Source(root, download=download, boundary=boundary,
+                                              num_valid=num_valid, num_label=num_label, seed=seed)
+            source = _sources[key]
+        self.source = source
+
+        if self.split == 'label':
+            self.index = source.manifest['label']
+            print('Label: ', len(self.index))  # label
+
+        elif self.split == 'unlabel':
+            self.index = source.manifest['unlabel']
+            print('Unlabel: ', len(self.index))  # unlabel
+
+        elif self.split == 'valid':
+            self.index = source.manifest['valid']
+            print('Valid: ', len(self.index))  # valid
+
+        elif self.split == 'pseudo':
+            # an index view over the unlabeled pool: selecting samples never copies images
+            self.index = source.manifest['unlabel'][np.asarray(self.indices, dtype=np.int64)]
+            self.labels = np.asarray(self.labels, dtype=np.int64)
+            print('Pseudo: ', len(self.index))
+
+        elif self.split == 'test':
+            self.index = source.manifest['test']
+
+    @property
+    def data(self):
+        return self.source.test_data if self.split == 'test' else self.source.train_data
+
+    @property
+    def targets(self):
+        return self.source.test_targets if self.split == 'test' else self.source.train_targets
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int): Index
+        Returns:
+            tuple: (image, target) where target is index of the target class.
+        """
+        img = self.data[self.index[index]]
+        if self.split == 'pseudo':
+            target = int(self.labels[index])
+        else:
+            target = int(self.targets[self.index[index]])
+
+        # doing this so that it is consistent with all other datasets
+        # to return a PIL Image
+        img = Image.fromarray(img)
+
+        if self.transform is not None:
+            if self.two_transform is not None:
+                # both views are built from the same decoded image (see also MultiViewDataset)
+                return self.transform(img), self.two_transform(img), target
+            img = self.transform(img)
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target
+
+    def __len__(self):
+        return len(self.index)
+
     def __repr__(self):
         fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
         fmt_str += '    Number of datapoints: {}\n'.format(self.__len__())
-        tmp = 'train' if self.train is True else 'test'
-        fmt_str += '    Split: {}\n'.format(tmp)
+        fmt_str += '    Split: {}\n'.format(self.split)
         fmt_str += '    Root Location: {}\n'.format(self.root)
         tmp = '    Transforms (if any): '
         fmt_str += '{0}{1}\n'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
@@ -284,8 +301,32 @@ class CIFAR10(data.Dataset):
         return fmt_str
 
 
+def split_indices(targets, nclass, boundary=0, num_valid=500, num_label=400, seed=None):
+    """Partitions sample indices into valid/label/unlabel splits.
+
+    Samples are visited in file order rotated by ``5000 * boundary`` (shuffled when ``seed``
+    is given); the first ``num_valid`` of each class go to valid, the next ``num_label`` to
+    label and the remainder to unlabel.
+    """
+    order = np.roll(np.arange(len(targets)), -5000 * boundary)
+    if seed is not None:
+        order = np.random.RandomState(seed).permutation(order)
+    labels = targets[order]
+
+    # rank of every sample among the samples of its class, in visiting order
+    counts = np.bincount(labels, minlength=nclass)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[np.argsort(labels, kind='stable')] = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return {'valid': order[rank < num_valid],
+            'label': order[(rank >= num_valid) & (rank < num_valid + num_label)],
+            'unlabel': order[rank >= num_valid + num_label]}
+
+
 def get_augmentation(img_size=32, ver=1):
-    if ver == 1:
+    if ver == 0: # uint8 CHW tensor, augmented and normalized later on the training device
+        transform = transforms.PILToTensor()
+    elif ver == 1:
         transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Resize((img_size, img_size)),
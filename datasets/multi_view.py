@@ -0,0 +1,20 @@
+from torch.utils.data import Dataset
+
+
+class MultiViewDataset(Dataset):
+    """Decodes each sample of ``dataset`` once and returns one view per transform pipeline.
+
+    ``dataset`` must return untransformed samples, ``(image, *rest)``; this returns
+    ``(view_1, ..., view_K, *rest)`` with ``view_k = transforms[k](image)``. Covers weak/strong
+    pairs (FixMatch, MPL), positive pairs (SimCLR, SupCon) and multi-crop setups alike.
+    """
+    def __init__(self, dataset, transforms):
+        self.dataset = dataset
+        self.transforms = list(transforms)
+
+    def __getitem__(self, idx):
+        img, *rest = self.dataset[idx]
+        return (*(transform(img) for transform in self.transforms), *rest)
+
+    def __len__(self):
+        return len(self.dataset)
@@ -0,0 +1,73 @@
+import contextlib
+
+import torch
+
+
+def _apply(batch, fn):
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_apply(b, fn) for b in batch)
+    return batch
+
+
+class DevicePrefetcher(object):
+    """Wraps a loader so that its batches arrive on ``device`` ready to use.
+
+    On CUDA the batch after the current one is copied from pinned memory, and passed through
+    ``transform`` if given, on a side stream while the loop works on the current batch. On any
+    other device the loader's tensors are handed over as they are, only ``transform`` is applied.
+    The copies and the transform are timed as the ``h2d`` and ``augment`` stages of ``timer``.
+    A loader with a ``handed()`` method (an InfiniteLoader) is told when each batch is handed over.
+    """
+    def __init__(self, loader, device, transform=None, timer=None):
+        self.loader = loader
+        self.device = device
+        self.transform = transform
+        self.timer = timer
+
+    def _stage(self, name):
+        return self.timer.stage(name) if self.timer is not None else contextlib.nullcontext()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                if self.transform is not None:
+                    with self._stage('augment'):
+                        batch = self.transform(batch)
+                self._handed()
+                yield batch
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+        upcoming = self._preload(iterator, stream)
+        while upcoming is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = upcoming
+            # the tensors were allocated on the side stream but are used (and freed) on the current one
+            _apply(batch, lambda t: t.record_stream(current))
+            upcoming = self._preload(iterator, stream)
+            self._handed()
+            yield batch
+
+    def _handed(self):
+        if hasattr(self.loader, 'handed'):
+            self.loader.handed()
+
+    def _preload(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            with self._stage('h2d'):
+                batch = _apply(batch, lambda t: (t if t.is_pinned() else t.pin_memory()).to(self.device, non_blocking=True))
+            if self.transform is not None:
+                with self._stage('augment'):
+                    batch = self.transform(batch)
+        return batch
@@ -0,0 +1,97 @@
+"""Packed shard format for image datasets made of many small files.
+
+A shard directory holds ``meta.json`` and, per shard, three files:
+    shard_XXXXX.bin        decoded uint8 HWC images, concatenated
+    shard_XXXXX.idx.npy    int64 array of (offset, height, width, channels) per image
+    shard_XXXXX.label.npy  label per image
+``meta.json`` is written last, so a directory without it is an incomplete pack.
+"""
+import os
+import json
+import argparse
+from os.path import join as opj
+
+import cv2
+import numpy as np
+import pandas as pd
+
+
+def pack_shards(df, data_path, out_dir, img_size=None, shard_bytes=512 * 2 ** 20):
+    """Decodes every ``df['file_name']`` under ``data_path`` once and writes them as shards.
+    Args:
+        df (DataFrame): With ``file_name`` and ``label`` columns, as used by ``Custom_Dataset``.
+        img_size (int, optional): If given, images are resized to ``img_size x img_size`` before packing.
+        shard_bytes (int): A new shard is started once a shard reaches this many image bytes.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    writer = None
+
+    def close(writer):
+        fo, name, index, labels = writer
+        fo.close()
+        os.replace(opj(out_dir, name + '.bin.tmp'), opj(out_dir, name + '.bin'))
+        np.save(opj(out_dir, name + '.idx.npy'), np.array(index, dtype=np.int64).reshape(-1, 4))
+        np.save(opj(out_dir, name + '.label.npy'), np.array(labels))
+        shards.append({'name': name, 'count': len(index)})
+
+    for file_name, label in zip(df['file_name'].values, df['label'].values):
+        image = cv2.imread(opj(data_path, file_name))
+        if image is None:
+            raise RuntimeError(f'Could not read {opj(data_path, file_name)}')
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if img_size is not None:
+            image = cv2.resize(image, (img_size, img_size), interpolation=cv2.INTER_AREA)
+
+        if writer is None:
+            name = 'shard_{:05d}'.format(len(shards))
+            writer = (open(opj(out_dir, name + '.bin.tmp'), 'wb'), name, [], [])
+        fo, _, index, labels = writer
+        index.append((fo.tell(), *image.shape))
+        labels.append(label)
+        fo.write(np.ascontiguousarray(image).tobytes())
+        if fo.tell() >= shard_bytes:
+            close(writer)
+            writer = None
+    if writer is not None:
+        close(writer)
+
+    meta = {'shards': shards, 'num_samples': sum(s['count'] for s in shards), 'img_size': img_size}
+    with open(opj(out_dir, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(opj(out_dir, 'meta.json.tmp'), opj(out_dir, 'meta.json'))
+    print(f'Packed {meta["num_samples"]} images into {len(shards)} shards')
+    return meta
+
+
+def load_meta(shard_dir):
+    with open(opj(shard_dir, 'meta.json')) as f:
+        return json.load(f)
+
+
+def load_shard_index(shard_dir, name):
+    """Returns the (offset, h, w, c) index and the labels of one shard."""
+    return np.load(opj(shard_dir, name + '.idx.npy')), np.load(opj(shard_dir, name + '.label.npy'))
+
+
+def open_shard(shard_dir, name):
+    return np.memmap(opj(shard_dir, name + '.bin'), dtype=np.uint8, mode='r')
+
+
+def read_image(shard, row):
+    """uint8 HWC view of the image described by index ``row``; no copy is made."""
+    offset, h, w, c = (int(v) for v in row)
+    return shard[offset:offset + h * w * c].reshape(h, w, c)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default='../data')
+    parser.add_argument('--file_name', type=str, default='train_df.csv')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--img_size', type=int, default=None, help='Pre-resize images while packing')
+    parser.add_argument('--shard_mb', type=int, default=512)
+    args = parser.parse_args()
+
+    df = pd.read_csv(opj(args.data_path, args.file_name))
+    pack_shards(df, args.data_path, args.out_dir, img_size=args.img_size, shard_bytes=args.shard_mb * 2 ** 20)
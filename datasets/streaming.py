@@ -0,0 +1,96 @@
+import numpy as np
+from PIL import Image
+
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from datasets.shards import load_meta, load_shard_index, open_shard, read_image
+
+
+class ShardStream(IterableDataset):
+    """Streams samples from a shard directory written by ``datasets.shards.pack_shards``.
+
+    Meant for unlabeled pools too large for memory: shards are split across distributed ranks
+    and DataLoader workers, each worker keeps at most one shard index and ``shuffle_buffer``
+    sample references in memory, and images are read through memory maps on demand.
+    The stream is deterministic given ``seed`` and the epoch, so it can be resumed mid-epoch.
+    Under a process group every rank stops after the same number of ``batch_size`` batches
+    (that of the rank with the fewest samples), so keep shard sizes roughly even.
+    Yields ``(view_1, ..., view_K, label)`` with one view per entry of ``transforms``.
+    """
+    def __init__(self, shard_dir, transforms, shuffle_buffer=10000, seed=0, batch_size=1):
+        self.shard_dir = shard_dir
+        self.transforms = list(transforms)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.skip_batches = 0
+        self.batch_size = batch_size
+
+        meta = load_meta(shard_dir)
+        self.names = [s['name'] for s in meta['shards']]
+        self.counts = [s['count'] for s in meta['shards']]
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+
+    def set_epoch(self, epoch):
+        """Selects the shard order and shuffling of ``epoch``; clears any pending resume."""
+        self.epoch = epoch
+        self.skip_batches = 0
+
+    def resume(self, consumed_batches, batch_size):
+        """Skips the first ``consumed_batches`` batches of the current epoch on the next iteration.
+
+        The remaining samples are exactly those not yet seen, but since a fresh DataLoader starts
+        again at worker 0, batches may come in a different order than in the interrupted run.
+        """
+        self.skip_batches = consumed_batches
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return min(sum(self.counts[rank::self.world_size]) for rank in range(self.world_size))
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        stream_id = self.rank * num_workers + worker_id
+        num_streams = self.world_size * num_workers
+
+        # every stream sees the same shard order and takes its own slice of it
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.names))
+        rng = np.random.default_rng([self.seed, self.epoch, stream_id])
+        # the DataLoader takes batches from workers round-robin
+        skip = len(range(worker_id, self.skip_batches, num_workers)) * self.batch_size
+        # ranks must not run different numbers of steps
+        stop = len(range(worker_id, len(self) // self.batch_size, num_workers)) * self.batch_size \
+            if self.world_size > 1 else None
+
+        opened = {}
+        for i, (shard_id, row) in enumerate(self._shuffled(order[stream_id::num_streams], rng)):
+            if i == stop:
+                return
+            if i < skip:
+                continue
+            if shard_id not in opened:
+                name = self.names[shard_id]
+                opened[shard_id] = (open_shard(self.shard_dir, name), *load_shard_index(self.shard_dir, name))
+            shard, index, labels = opened[shard_id]
+            img = np.array(read_image(shard, index[row]))
+            img = Image.fromarray(img[..., 0] if img.shape[-1] == 1 else img)
+            yield (*(transform(img) for transform in self.transforms), int(labels[row]))
+
+    def _shuffled(self, shard_ids, rng):
+        """Yields (shard, row) references through a bounded shuffle buffer."""
+        buffer = []
+        for shard_id in shard_ids:
+            for row in rng.permutation(self.counts[shard_id]):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((shard_id, row))
+                    continue
+                j = rng.integers(len(buffer))
+                yield buffer[j]
+                buffer[j] = (shard_id, row)
+        rng.shuffle(buffer)
+        yield from buffer
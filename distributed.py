@@ -0,0 +1,149 @@
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, Sampler
+
+
+def init_distributed(args):
+    """Joins the process group when launched by torchrun (``WORLD_SIZE`` > 1), e.g.
+    ``torchrun --nproc_per_node=4 train_sup.py --device cpu``. Only rank 0 keeps stdout.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or is_distributed():
+        return
+    if args.device == 'cuda' and torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    dist.init_process_group(backend=args.dist_backend)
+    if not is_main_process():
+        sys.stdout = open(os.devnull, 'w')
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def unwrap(model):
+    """The module inside a DistributedDataParallel wrapper (state_dicts are saved without ``module.``)."""
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def reduce_mean(tensor):
+    """Mean of ``tensor`` over ranks (gloo has no AVG reduction)."""
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor)
+    return tensor / get_world_size()
+
+
+class GatherLayer(torch.autograd.Function):
+    """all_gather that keeps the graph: every rank gets the gradient of its own slice,
+    summed over the ranks that used it."""
+    @staticmethod
+    def forward(ctx, x):
+        out = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(out, x.contiguous())
+        return tuple(out)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        grads = torch.stack(grads)
+        dist.all_reduce(grads)
+        return grads[dist.get_rank()]
+
+
+def all_gather(tensor):
+    """Concatenates ``tensor`` (same shape on every rank) over ranks along dim 0, differentiably."""
+    if not is_distributed():
+        return tensor
+    return torch.cat(GatherLayer.apply(tensor))
+
+
+def gather_strided(array):
+    """Reassembles a numpy array computed on the ``ShardSampler(shuffle=False)`` slices of every rank."""
+    if not is_distributed():
+        return array
+    parts = [None] * get_world_size()
+    dist.all_gather_object(parts, array)
+    out = np.empty(sum(len(p) for p in parts), dtype=array.dtype)
+    for rank, part in enumerate(parts):
+        out[rank::len(parts)] = part
+    return out
+
+
+class ShardSampler(Sampler):
+    """This rank's share of ``range(num_samples)``.
+
+    With ``shuffle``, every pass draws a new permutation from ``(seed, epoch)`` (the epoch
+    advances on each iteration) and the tail is dropped so that all ranks run the same number
+    of steps. Without it ranks take strided slices in order, covering every sample exactly once.
+    Shuffled loaders use it in single-process runs too, so that an epoch's order can be replayed
+    on ``--resume``.
+    """
+    def __init__(self, num_samples, shuffle, seed=0):
+        self.total = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+        self.rank, self.world_size = get_rank(), get_world_size()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.skip = 0
+
+    def resume(self, consumed_batches, batch_size):
+        """Skips the first ``consumed_batches`` batches of the current epoch on the next iteration."""
+        self.skip = consumed_batches * batch_size
+
+    def __len__(self):
+        if self.shuffle:
+            return self.total // self.world_size
+        return len(range(self.rank, self.total, self.world_size))
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        if not self.shuffle:
+            return iter(range(self.rank, self.total, self.world_size)[skip:])
+        g = torch.Generator()
+        g.manual_seed(self.seed * 100003 + self.epoch)
+        self.epoch += 1
+        perm = torch.randperm(self.total, generator=g)[:len(self) * self.world_size]
+        return iter(perm[self.rank::self.world_size][skip:].tolist())
+
+
+def loader_generator(seed=0):
+    """Generator of a DataLoader, so that ``iter(loader)`` draws the worker base seed from it
+    rather than from the global torch RNG (which ``--resume`` restores)."""
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return generator
+
+
+def sampler_args(dataset, shuffle, seed=0):
+    """DataLoader ``shuffle``/``sampler``/``generator`` arguments giving this rank its share of ``dataset``."""
+    args = {'generator': loader_generator(seed)}
+    if isinstance(dataset, IterableDataset):
+        return args  # streams split themselves across ranks
+    if not shuffle and not is_distributed():
+        return dict(args, shuffle=False)
+    return dict(args, sampler=ShardSampler(len(dataset), shuffle, seed))
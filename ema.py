@@ -0,0 +1,53 @@
+import copy
+
+import torch
+
+from distributed import unwrap
+
+
+class ModelEMA(object):
+    """Exponential moving average of a model's weights, kept in ``module`` (always in eval mode).
+
+    ``update()`` is called after every optimizer step and averages every ``every`` calls, using
+    ``decay ** every`` so that the horizon does not depend on the interval. All parameters are
+    updated at once with multi-tensor ``torch._foreach_*`` ops. BN running statistics are copied
+    from the model (``buffers='copy'``) or averaged like the weights (``'average'``); integer
+    buffers such as ``num_batches_tracked`` are always copied.
+    """
+    def __init__(self, model, decay=0.999, every=1, buffers='copy'):
+        if buffers not in ('copy', 'average'):
+            raise ValueError(f'Unknown EMA buffer mode {buffers!r}, expected copy or average')
+        model = unwrap(model)
+        self.module = copy.deepcopy(model).eval().requires_grad_(False)
+        self.decay = decay
+        self.every = every
+        self.updates = 0
+
+        # (ema tensors, model tensors) for the lerp and for the copy
+        averaged = list(zip(self.module.parameters(), model.parameters()))
+        copied = list(zip(self.module.buffers(), model.buffers()))
+        if buffers == 'average':
+            averaged += [(e, b) for e, b in copied if b.is_floating_point()]
+            copied = [(e, b) for e, b in copied if not b.is_floating_point()]
+        self.averaged = [list(x) for x in zip(*averaged)]
+        self.copied = [list(x) for x in zip(*copied)] or [[], []]
+
+    @torch.no_grad()
+    def update(self):
+        self.updates += 1
+        if self.updates % self.every:
+            return
+        ema, model = self.averaged
+        torch._foreach_lerp_(ema, model, 1 - self.decay ** self.every)
+        if self.copied[0]:
+            torch._foreach_copy_(*self.copied)
+
+    def __call__(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+    def state_dict(self):
+        return {'module': self.module.state_dict(), 'updates': self.updates}
+
+    def load_state_dict(self, state):
+        self.module.load_state_dict(state['module'])
+        self.updates = state['updates']
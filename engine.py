@@ -0,0 +1,281 @@
+import time
+import weakref
+import contextlib
+
+import numpy as np
+from tqdm import tqdm
+import torch
+import torch.nn as nn
+
+from utils import _disable_tracking_bn_stats
+from distributed import is_distributed
+from timing import StageTimer
+
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class Engine(object):
+    """Optimization step shared by the trainers, with optional mixed precision and compilation.
+
+    Forward passes (and losses) run inside ``autocast()`` and gradients go through ``step``, or
+    through ``backward`` and ``update`` when several losses or optimizers share one step.
+    ``amp`` is 'none', 'bf16' or 'fp16'. Only fp16 needs loss scaling; bf16 keeps the fp32
+    exponent range and is also the mode for CPUs with native bf16 support.
+
+    ``compile`` is 'none' or a ``torch.compile`` mode. Modules and step functions passed to
+    ``compile()`` run eagerly for the first ``warmup_steps`` updates, which gives the eager
+    baseline, and are compiled from then on; see ``CompileProfiler`` for the report.
+
+    ``micro_batch_size`` (0: whole batches, else at least 2) splits every step of ``accumulate``
+    and ``cached_step`` into micro-batches whose gradients are accumulated before one update,
+    so the batch size sets the optimization batch and the micro-batch size the memory.
+
+    Under torchrun, models go through ``distribute`` and are wrapped in DistributedDataParallel;
+    gradients are then all-reduced only on the last micro-batch of a step (see ``no_sync``).
+
+    With ``time_stages`` the forward passes, backward passes and optimizer updates are timed
+    by ``timer`` (see ``StageTimer``).
+    """
+    warmup_steps = 10
+    measure_steps = 20
+
+    def __init__(self, device, amp='none', compile='none', micro_batch_size=0, time_stages=False):
+        if amp != 'none' and amp not in AMP_DTYPES:
+            raise ValueError(f'Unknown amp mode {amp!r}, expected none, bf16 or fp16')
+        if amp == 'fp16' and device.type != 'cuda':
+            raise ValueError('fp16 autocast needs a CUDA device, use --amp bf16 on CPU')
+        if micro_batch_size == 1 or micro_batch_size < 0:
+            raise ValueError(f'--micro_batch_size must be 0 (no splitting) or at least 2, got {micro_batch_size}')
+        self.device = device
+        self.dtype = AMP_DTYPES.get(amp)
+        self.scaler = torch.amp.GradScaler('cuda', enabled=amp == 'fp16')
+        self.micro_batch_size = micro_batch_size
+
+        self.compile_mode = compile
+        self.compiled = False
+        self.targets = weakref.WeakSet()
+        # total number of updates of the run, set by the trainer for the compile report
+        self.total_steps = None
+        self.profiler = CompileProfiler(self) if compile != 'none' else None
+        self.replicas = weakref.WeakSet()
+        self.timer = StageTimer(device, time_stages)
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def compile(self, target):
+        """Registers a module (compiled in place) or a step function (returns its compiled stand-in)."""
+        if self.profiler is None:
+            return target
+        if not isinstance(target, nn.Module):
+            target = _LazyCompiled(target, self)
+        self.targets.add(target)
+        if self.compiled:
+            target.compile(mode=self.compile_mode)
+        return target
+
+    def _compile_targets(self):
+        # batch sizes change at most once (last partial batch), after which dynamo marks them dynamic
+        for target in self.targets:
+            target.compile(mode=self.compile_mode)
+        self.compiled = True
+
+    def distribute(self, module, find_unused_parameters=False, process_group=None):
+        """Returns ``module`` wrapped in DistributedDataParallel when a process group is running.
+
+        A model trained on another thread needs its own ``process_group`` (``dist.new_group()``).
+        """
+        if not is_distributed():
+            return module
+        device_ids = [torch.cuda.current_device()] if self.device.type == 'cuda' else None
+        module = nn.parallel.DistributedDataParallel(module, device_ids=device_ids,
+                                                     find_unused_parameters=find_unused_parameters,
+                                                     process_group=process_group)
+        self.replicas.add(module)
+        return module
+
+    def no_sync(self, sync=False, modules=None):
+        """Skips the gradient all-reduce of every distributed model, or of ``modules`` (unless ``sync``)."""
+        stack = contextlib.ExitStack()
+        if not sync:
+            for module in list(self.replicas) if modules is None else modules:
+                if module in self.replicas:
+                    stack.enter_context(module.no_sync())
+        return stack
+
+    def backward(self, loss):
+        with self.timer.stage('backward'):
+            self.scaler.scale(loss).backward()
+
+    def update(self, *optimizers, end_step=True):
+        """Steps ``optimizers``; ``end_step=False`` when more updates follow within the same training step."""
+        with self.timer.stage('optimizer'):
+            for optimizer in optimizers:
+                self.scaler.step(optimizer)
+            self.scaler.update()
+        if self.profiler is not None and end_step:
+            self.profiler.tick()
+
+    def step(self, loss, *optimizers):
+        self.backward(loss)
+        self.update(*optimizers)
+
+    def chunks(self, batch_size):
+        """Slices splitting a batch of ``batch_size`` into the fewest micro-batches of at most
+        ``micro_batch_size``, with sizes differing by at most one (e.g. 16 by 5: 4, 4, 4, 4).
+        Micro-batches keep at least 2 samples, so one may be a sample over (e.g. 3 by 2: 3)."""
+        size = self.micro_batch_size if 0 < self.micro_batch_size < batch_size else batch_size
+        # BN은 train mode에서 1개 sample의 batch를 처리할 수 없음
+        num_chunks = max(min(-(-batch_size // size), batch_size // 2), 1)
+        sizes = [batch_size // num_chunks + (i < batch_size % num_chunks) for i in range(num_chunks)]
+        bounds = np.cumsum([0] + sizes)
+        return [slice(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def accumulate(self, step_fn, batch, *optimizers):
+        """One optimization step over ``batch`` (a tuple of tensors sharing their first dimension).
+
+        ``step_fn(*micro_batch)`` returns the micro-batch's mean loss, optionally followed by
+        per-sample outputs. Each loss is backpropagated weighted by its share of the batch, so
+        the accumulated gradient is that of the batch mean. Returns the batch loss and the
+        outputs concatenated over micro-batches.
+        """
+        n = batch[0].size(0)
+        loss, outputs = 0, []
+        for s in self.chunks(n):
+            with self.no_sync(s.stop == n):
+                with self.timer.stage('forward'):
+                    out = step_fn(*(t[s] for t in batch))
+                part, *rest = out if isinstance(out, tuple) else (out,)
+                weight = (s.stop - s.start) / n
+                self.backward(part * weight)
+            loss = loss + part.detach() * weight
+            outputs.append([r.detach() for r in rest])
+        self.update(*optimizers)
+        if not outputs[0]:
+            return loss
+        return (loss, *(torch.cat(o) for o in zip(*outputs)))
+
+    def cached_step(self, model, encode, views, loss_fn, *optimizers):
+        """One optimization step of a loss coupling the whole batch, such as a contrastive loss.
+
+        Plain accumulation would only contrast samples within a micro-batch. Instead the
+        representations ``encode(x)`` of every view in ``views`` are first computed without a
+        graph (and without updating BN running statistics), ``loss_fn(representations)`` is
+        backpropagated to them, and every micro-batch is then encoded again under the same RNG
+        state and backpropagated with its cached gradient (GradCache).
+        """
+        n = views[0].size(0)
+        slices = self.chunks(n)
+        if len(slices) == 1:
+            with self.timer.stage('forward'), self.autocast():
+                loss = loss_fn([encode(view) for view in views])
+            self.step(loss, *optimizers)
+            return loss.detach()
+
+        states, reps = [], []
+        with self.timer.stage('forward'), torch.no_grad(), _disable_tracking_bn_stats(model), self.autocast():
+            for view in views:
+                parts = []
+                for s in slices:
+                    states.append(self._rng_state())
+                    parts.append(encode(view[s]))
+                reps.append(torch.cat(parts).float().requires_grad_())
+        with self.timer.stage('forward'), self.autocast():
+            loss = loss_fn(reps)
+        self.backward(loss)
+
+        states = iter(states)
+        for i, (view, rep) in enumerate(zip(views, reps)):
+            for s in slices:
+                with self.no_sync(i == len(views) - 1 and s.stop == n):
+                    with self.timer.stage('forward'), self._replay_rng(next(states)), self.autocast():
+                        part = encode(view[s])
+                    # rep.grad already carries the loss scale
+                    with self.timer.stage('backward'):
+                        part.backward(rep.grad[s].to(part.dtype))
+        self.update(*optimizers)
+        return loss.detach()
+
+    def _rng_state(self):
+        cuda = torch.cuda.get_rng_state(self.device) if self.device.type == 'cuda' else None
+        return torch.get_rng_state(), cuda
+
+    @contextlib.contextmanager
+    def _replay_rng(self, state):
+        with torch.random.fork_rng(devices=[self.device] if self.device.type == 'cuda' else []):
+            torch.set_rng_state(state[0])
+            if state[1] is not None:
+                torch.cuda.set_rng_state(state[1], self.device)
+            yield
+
+
+class _LazyCompiled(object):
+    def __init__(self, fn, engine):
+        self.fn = fn
+        self.engine = engine
+        self.compiled_fn = None
+
+    def compile(self, mode):
+        self.compiled_fn = torch.compile(self.fn, mode=mode)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled_fn is None:
+            return self.fn(*args, **kwargs)
+        return self.compiled_fn(*args, **kwargs)
+
+
+class CompileProfiler(object):
+    """Times whole training steps (update to update) around the switch to compiled code.
+
+    Steps are synchronized and timed only during the eager warmup and the first
+    ``measure_steps`` compiled steps; the first compiled steps carry the compile time.
+    The report compares compile cost with the per-step saving and the run's ``total_steps``.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.last = None
+        self.eager = []
+        self.compiled = []
+        self.report = None
+
+    def _sync(self):
+        if self.engine.device.type == 'cuda':
+            torch.cuda.synchronize(self.engine.device)
+
+    def tick(self):
+        if self.report is not None:
+            return
+        self._sync()
+        now = time.perf_counter()
+        if self.last is not None:
+            (self.compiled if self.engine.compiled else self.eager).append(now - self.last)
+        self.last = now
+
+        if not self.engine.compiled and len(self.eager) == self.engine.warmup_steps:
+            self.engine._compile_targets()
+            self.last = time.perf_counter()
+        elif len(self.compiled) == self.engine.measure_steps:
+            self.report = self.summarize()
+            tqdm.write(self.format(self.report))
+
+    def summarize(self):
+        eager = float(np.median(self.eager[len(self.eager) // 2:]))
+        compiled = float(np.median(self.compiled[len(self.compiled) // 2:]))
+        compile_time = sum(self.compiled) - compiled * len(self.compiled)
+        saving = eager - compiled
+        report = {'eager_step': eager, 'compiled_step': compiled, 'speedup': eager / compiled,
+                  'compile_time': compile_time,
+                  'break_even_steps': compile_time / saving if saving > 0 else float('inf')}
+        if self.engine.total_steps is not None:
+            report['run_saving'] = saving * self.engine.total_steps - compile_time
+        return report
+
+    def format(self, report):
+        line = (f"Compile | Eager:{report['eager_step'] * 1e3:.1f}ms/step | Compiled:{report['compiled_step'] * 1e3:.1f}ms/step"
+                f" | Speedup:{report['speedup']:.2f}x | Compile time:{report['compile_time']:.1f}s"
+                f" | Break-even:{report['break_even_steps']:.0f} steps")
+        if 'run_saving' in report:
+            line += f" | Net saving over the run:{report['run_saving'] / 60:.1f}Minute"
+        return line
@@ -1,5 +1,8 @@
 import os
 import time
+import queue
+import threading
+import contextlib
 import random
 import pprint
 from os.path import join as opj
@@ -10,6 +13,7 @@ from tqdm import tqdm
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 import torch_optimizer as optim
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
@@ -17,31 +21,157 @@ from torch.utils.tensorboard import SummaryWriter
 
 from model import *
 from utils import *
+from utils import _disable_tracking_bn_stats
 from config import getConfig
-from datasets.loader_cifar import CIFAR10, get_augmentation
+from engine import Engine
+from checkpoint import CheckpointWriter, RunState, seek_loader
+from distributed import init_distributed, get_rank, is_main_process, is_distributed, unwrap, sampler_args, reduce_mean
+from datasets.loader_cifar import CIFAR10Source
+from datasets.infinite import InfiniteLoader
+from datasets.batch_augment import get_views, get_unlabel_views, to_device_views
 
 import warnings
 warnings.filterwarnings('ignore')
 
+def _tensors(value):
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _tensors(v)
+
+
+class TeacherPipeline(object):
+    """Runs the MPL teacher on its own thread, one step ahead of the student (``--mpl_pipeline``).
+
+    For every batch the teacher first hands out the student's pseudo labels (a forward without a
+    graph), then takes the student's feedback for the previous batch and applies its own update
+    for it. The student thus trains on step t while the teacher trains on step t-1, and the
+    pseudo labels come from teacher weights one update older than in the sequential step.
+    ``flush`` waits for the pending teacher update, e.g. before a checkpoint.
+
+    On CPU the teacher thread gets ``threads`` of the intra-op threads (half by default) and the
+    main thread the rest; on CUDA it runs on its own stream. The teacher losses go to ``meter``.
+    """
+    def __init__(self, trainer, threads=0):
+        self.trainer = trainer
+        self.meter = MetricMeter(trainer.device)
+        self.main_threads = torch.get_num_threads()
+        self.threads = threads or max(self.main_threads // 2, 1)
+        torch.set_num_threads(max(self.main_threads - self.threads, 1))
+        self.stream = torch.cuda.Stream(trainer.device) if trainer.device.type == 'cuda' else None
+        self.inbox, self.outbox, self.feedbacks = queue.Queue(), queue.Queue(), queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='mpl-teacher', daemon=True)
+        self.thread.start()
+
+    def pseudo_labels(self, batch):
+        """Queues ``batch`` (images_l, targets, images_us, images_uh) and returns its pseudo labels."""
+        self._put(self.inbox, ('batch', batch))
+        return self._get(self.outbox)
+
+    def feedback(self, dot_product):
+        """Sends the student's feedback for the last batch."""
+        self._put(self.feedbacks, dot_product)
+
+    def flush(self):
+        self._put(self.inbox, ('flush', None))
+        self._get(self.outbox)
+
+    def close(self):
+        self.flush()
+        self._put(self.inbox, ('stop', None))
+        self.thread.join()
+        torch.set_num_threads(self.main_threads)
+
+    def _put(self, box, value):
+        # CUDA: 받는 쪽 stream이 보내는 쪽 stream의 작업을 기다리도록 event 전달
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+        box.put((value, event))
+
+    def _get(self, box):
+        value, event = box.get()
+        if isinstance(value, BaseException):
+            raise RuntimeError('The MPL teacher thread failed') from value
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            for tensor in _tensors(value):
+                tensor.record_stream(stream)
+        return value
+
+    def _run(self):
+        torch.set_num_threads(self.threads)
+        stream = torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()
+        previous = None
+        try:
+            with stream:
+                while True:
+                    kind, batch = self._get(self.inbox)
+                    if kind == 'batch':
+                        self._put(self.outbox, self.trainer.teacher_pseudo_labels(batch[2]))
+                    if previous is not None:
+                        self._update(previous, self._get(self.feedbacks))
+                    previous = batch
+                    if kind != 'batch':
+                        self._put(self.outbox, None)
+                    if kind == 'stop':
+                        return
+        except BaseException as e:
+            self.outbox.put((e, None))
+
+    def _update(self, batch, dot_product):
+        self.trainer.teacher.zero_grad(set_to_none=True)
+        t_loss_uda, t_loss_mpl = self.trainer.teacher_step(*batch, dot_product, end_step=False)
+        self.meter.update(batch[0].size(0), t_loss=t_loss_uda + t_loss_mpl, t_uda=t_loss_uda, t_mpl=t_loss_mpl)
+
+
 class Trainer():
     def __init__(self, args):
         self.args = args
         self.device = torch.device('cuda' if torch.cuda.is_available() and args.device == 'cuda' else 'cpu')
+        self.engine = Engine(self.device, args.amp, args.compile, args.micro_batch_size, args.time_stages)
         self.student = Network(args).to(self.device)
         self.teacher = Network(args).to(self.device)
-
-        self.train_ds = CIFAR10(args.data_path, split='label', download=True, transform=get_augmentation(ver=2), boundary=0)
-        self.unlabel_ds = CIFAR10(args.data_path, split='unlabel', download=True, transform=get_augmentation(ver=2), boundary=0, two_transform = get_augmentation(ver=3))
-        self.val_ds = CIFAR10(args.data_path, split='valid', download=True, transform=get_augmentation(ver=1), boundary=0)
-        self.test_ds = CIFAR10(args.data_path, split='test', download=True, transform=get_augmentation(ver=1), boundary=0)
-
-        self.train_dl = DataLoader(self.train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=True)
-        self.unlabel_dl = DataLoader(self.unlabel_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=True)
-        self.val_dl = DataLoader(self.val_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
-        self.test_dl = DataLoader(self.test_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        self.engine.compile(self.student)
+        self.engine.compile(self.teacher)
+        self.student = self.engine.distribute(self.student)
+        teacher_group = None
+        if args.mpl_pipeline:
+            if args.amp == 'fp16' or args.compile != 'none':
+                raise ValueError('--mpl_pipeline does not support --amp fp16 or --compile')
+            # Teacher의 gradient all-reduce는 teacher thread에서 실행되므로 별도의 process group 사용
+            teacher_group = dist.new_group() if is_distributed() else None
+        self.teacher = self.engine.distribute(self.teacher, process_group=teacher_group)
+
+        self.source = CIFAR10Source(args.data_path, download=True, boundary=0, num_valid=args.num_valid,
+                                    num_label=args.num_label, seed=args.split_seed)
+        self.train_ds = get_views(self.source.split('label'), [2], args)
+        self.unlabel_ds = get_unlabel_views(self.source, [2, 3], args)
+        self.val_ds = get_views(self.source.split('valid'), [1], args)
+        self.test_ds = get_views(self.source.split('test'), [1], args)
+
+        self.train_dl = to_device_views(DataLoader(self.train_ds, batch_size=args.batch_size, **sampler_args(self.train_ds, shuffle=True, seed=args.seed), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda', drop_last=True), [2], args, self.device, timer=self.engine.timer)
+        self.labeled_dl = to_device_views(InfiniteLoader(self.train_ds, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=self.device.type == 'cuda', seed=args.seed,
+                                                         on_wrap=lambda: self.scheduler_s.step()), [2], args, self.device, timer=self.engine.timer)
+        self.labeled_iter = iter(self.labeled_dl)
+        self.unlabel_dl = to_device_views(DataLoader(self.unlabel_ds, batch_size=args.batch_size, **sampler_args(self.unlabel_ds, shuffle=True, seed=args.seed), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda', drop_last=True), [2, 3], args, self.device, timer=self.engine.timer)
+        self.val_dl = to_device_views(DataLoader(self.val_ds, batch_size=args.batch_size, **sampler_args(self.val_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.test_dl = to_device_views(DataLoader(self.test_ds, batch_size=args.batch_size, **sampler_args(self.test_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.engine.total_steps = args.epochs * len(self.unlabel_dl)
 
         self.save_path = args.save_path
-        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard else None
+        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard and is_main_process() else None
+        self.checkpoint = CheckpointWriter()
+        self.run = RunState(args, self.checkpoint, ['train', 'finetune'])
+
+    def state_objects(self):
+        return {'student': unwrap(self.student), 'teacher': unwrap(self.teacher),
+                'optimizer_s': self.optimizer_s, 'optimizer_t': self.optimizer_t,
+                'scheduler_s': self.scheduler_s, 'scheduler_t': self.scheduler_t,
+                'scaler': self.engine.scaler, 'stopper': self.stopper}
 
     def close_writer(self):
         if self.writer is not None:
@@ -71,23 +201,24 @@ class Trainer():
                                                                  steps_per_epoch=iter_per_epoch, epochs=args.epochs)
 
     def train(self):
+        if self.run.done('train'):
+            return
         self.init_setting(self.args)
         start = time.time()
 
         # Early stopping
-        best_epoch = 0
-        best_loss = np.inf
-        best_acc = 0
-        best_acc2 = 0
-        early_stopping = 0
-
-        for epoch in range(self.args.epochs):
+        self.stopper = EarlyStopping(self.args.patience)
+        start_epoch, start_step = self.run.restore('train', self.state_objects())
+        # 학습 step마다 labeled batch 하나를 사용
+        self.labeled_dl.loader.resume(start_epoch * len(self.unlabel_dl) + start_step)
 
+        for epoch in range(start_epoch, self.args.epochs):
             if self.args.scheduler == 'cos':
-                if epoch > self.args.warm_epoch:
+                if epoch > self.args.warm_epoch and not start_step:
                     self.scheduler_t.step()
 
-            t_losses, t_udas, t_mpls, s_losses = self.train_one_epoch()
+            t_losses, t_udas, t_mpls, s_losses = self.train_one_epoch(epoch, start_step)
+            start_step = 0
             val_loss, val_top1, val_top5 = self.validate()
 
             if self.writer is not None:
@@ -104,71 +235,89 @@ class Trainer():
             print(
                 f'Epoch : {epoch} | Teacher Loss_total:{t_losses:.4f} | Teacher Loss_uda:{t_udas:.4f} | Teacher Loss_mpl:{t_mpls:.4f} | Student Loss_total:{s_losses:.4f}')
             print(f'Epoch : {epoch} | Val Loss:{val_loss:.4f}   | Val Top1:{val_top1:.4f}   | Val Top5:{val_top5:.4f}')
-            state_dict = self.student.state_dict()
-            state_dict_t = self.teacher.state_dict()
-
-            if val_loss < best_loss:
-                early_stopping = 0
-                best_epoch = epoch
-                best_loss = val_loss
-                best_acc = val_top1
-                best_acc2 = val_top5
-
-                torch.save({'epoch': epoch,
-                            'state_dict': state_dict,
-                            'state_dict_t': state_dict_t,
-                            'optimizer': self.optimizer_s.state_dict(),
-                            'scheduler': self.scheduler_s.state_dict(),
-                            }, os.path.join(self.save_path, 'best_model.pth'))
-            else:
-                early_stopping += 1
-
-            if early_stopping == self.args.patience:
+            state_dict = unwrap(self.student).state_dict()
+            state_dict_t = unwrap(self.teacher).state_dict()
+
+            if self.stopper.update(epoch, val_loss, val_top1, val_top5):
+                self.checkpoint.save({'epoch': epoch,
+                                      'state_dict': state_dict,
+                                      'state_dict_t': state_dict_t,
+                                      'optimizer': self.optimizer_s.state_dict(),
+                                      'scheduler': self.scheduler_s.state_dict(),
+                                      }, os.path.join(self.save_path, 'best_model.pth'))
+
+            self.run.save('train', self.args.epochs if self.stopper.stop else epoch + 1, 0, self.state_objects())
+            if self.stopper.stop:
                 break
 
             if self.writer is not None:
-                self.writer.add_scalar('Best/top1_accuracy', best_acc, epoch)
-                self.writer.add_scalar('Best/top5_accuracy', best_acc2, epoch)
-                self.writer.add_scalar('Best/loss', best_loss, epoch)
+                self.writer.add_scalar('Best/top1_accuracy', self.stopper.best_acc, epoch)
+                self.writer.add_scalar('Best/top5_accuracy', self.stopper.best_acc2, epoch)
+                self.writer.add_scalar('Best/loss', self.stopper.best_loss, epoch)
 
         end = time.time()
-        print(f'Best Epoch:{best_epoch} | Loss:{best_loss:.4f} | Top1:{best_acc:.4f} | Top5:{best_acc2:.4f}')
+        print(f'Best Epoch:{self.stopper.best_epoch} | Loss:{self.stopper.best_loss:.4f} | Top1:{self.stopper.best_acc:.4f} | Top5:{self.stopper.best_acc2:.4f}')
         print(f'Total Training time:{(end - start) / 60:.3f}Minute')
 
 
-    def train_one_epoch(self):
+    def train_one_epoch(self, epoch, start_step=0):
         self.student.train()
         self.teacher.train()
 
-        t_losses = 0
-        t_udas = 0
-        t_mpls = 0
-        s_losses = 0
+        meter = MetricMeter(self.device, log_interval=self.args.log_interval)
+        self.run.load('meter', meter)
+        seek_loader(self.unlabel_dl, epoch, start_step)
 
-        labeled_iter = iter(self.train_dl)
-        for images_us, images_uh, _ in tqdm(self.unlabel_dl):
-            images_us = torch.tensor(images_us, device=self.device, dtype=torch.float32)
-            images_uh = torch.tensor(images_uh, device=self.device, dtype=torch.float32)
+        pipeline = TeacherPipeline(self, self.args.teacher_threads) if self.args.mpl_pipeline else None
+        if pipeline is not None:
+            self.run.load('teacher_meter', pipeline.meter)
 
+        pbar = tqdm(self.engine.timer.iterate(self.unlabel_dl, self.writer), total=len(self.unlabel_dl), initial=start_step)
+        for step, (images_us, images_uh, _) in enumerate(pbar, start_step + 1):
             #Get labeled data
-            try:
-                images_l, targets = labeled_iter.next()
-            except:
-                self.scheduler_s.step()
-                labeled_iter = iter(self.train_dl)
-                images_l, targets = labeled_iter.next()
+            with self.engine.timer.stage('data'):
+                images_l, targets = next(self.labeled_iter)
 
-            images_l = torch.tensor(images_l, device=self.device, dtype=torch.float32)
-            targets = torch.tensor(targets, device=self.device, dtype=torch.long)
-
-            self.teacher.zero_grad(set_to_none=True)
-            self.student.zero_grad(set_to_none=True)
+            if pipeline is None:
+                self.teacher.zero_grad(set_to_none=True)
+                self.student.zero_grad(set_to_none=True)
 
+                t_loss, t_loss_uda, t_loss_mpl, s_loss = self.train_step(images_l, targets, images_us, images_uh)
+                meter.update(images_us.size(0), t_loss=t_loss, t_uda=t_loss_uda, t_mpl=t_loss_mpl, s_loss=s_loss)
+            else:
+                s_loss = self.train_step_pipelined(pipeline, images_l, targets, images_us, images_uh)
+                meter.update(images_us.size(0), s_loss=s_loss)
+            meter.log(pbar)
+            if self.run.due(step):
+                objects = dict(self.state_objects(), meter=meter)
+                if pipeline is not None:
+                    pipeline.flush()
+                    objects['teacher_meter'] = pipeline.meter
+                self.run.save('train', epoch, step, objects)
+
+        self.engine.timer.save(os.path.join(self.save_path, 'timing.jsonl'), phase='train', epoch=epoch)
+        if pipeline is not None:
+            pipeline.close()
+            return (*pipeline.meter.compute('t_loss', 't_uda', 't_mpl'), meter.compute('s_loss'))
+        return meter.compute('t_loss', 't_uda', 't_mpl', 's_loss')
+
+    def train_step_pipelined(self, pipeline, images_l, targets, images_us, images_uh):
+        """The student's part of an MPL step with the teacher on ``pipeline``: the teacher updates
+        on this batch once it has handed out the pseudo labels of the next one."""
+        with self.engine.timer.stage('teacher_wait'):
+            soft_pseudo_labels = pipeline.pseudo_labels((images_l, targets, images_us, images_uh))
+        self.student.zero_grad(set_to_none=True)
+        s_loss, dot_product = self.student_step(images_l, targets, images_uh, soft_pseudo_labels, end_step=True)
+        pipeline.feedback(dot_product)
+        return s_loss
+
+    def teacher_forward(self, images_l, targets, images_us, images_uh):
+        with self.engine.timer.stage('teacher_forward'), self.engine.autocast():
             t_images = torch.cat([images_l, images_us, images_uh])
             t_preds = self.teacher(t_images)
 
-            t_preds_l = t_preds[:self.args.batch_size]  # preds for only labelset
-            t_preds_us, t_preds_uh = t_preds[self.args.batch_size:].chunk(2)
+            t_preds_l = t_preds[:images_l.size(0)]  # preds for only labelset
+            t_preds_us, t_preds_uh = t_preds[images_l.size(0):].chunk(2)
             del t_preds
 
             # Teacher는 레이블된 데이터로 학습
@@ -181,46 +330,106 @@ class Trainer():
             t_loss_u = torch.mean(-(pseudo_label * torch.log_softmax(t_preds_uh, dim=-1)).sum(dim=-1) * mask)
             weight_u = self.args.lambda_u
             t_loss_uda = t_loss_l + weight_u * t_loss_u
-
-            # Student는 labelset과 hard_transfrom된 이미지 사용
-            s_images = torch.cat([images_l, images_uh])
-            s_preds = self.student(s_images)
-            s_preds_l = s_preds[:self.args.batch_size]
-            s_preds_uh = s_preds[self.args.batch_size:]
-            del s_preds
-
-            s_loss_l_old = F.cross_entropy(s_preds_l.detach(), targets)  # Teacher가 학습하기 위한 loss 계산(학습 전)
-            s_loss = self.criterion(s_preds_uh, soft_pseudo_label)  # Student는 Teacher로 인한 soft_psuedo_label를 이용하여 학습
-            s_loss.backward()
-
-            with torch.no_grad():
-                s_preds_l = self.student(images_l)
-
-            s_loss_l_new = F.cross_entropy(s_preds_l.detach(), targets)  # Teacher가 학습하기 위한 loss 계산(학습 후)
-
-            # Student의 labelset에 대한 학습 전과 학습 후의 loss 차이
-            dot_product = s_loss_l_new - s_loss_l_old
-            _, hard_pseudo_label = torch.max(t_preds_uh.detach(), dim=-1)
-
-            t_loss_mpl = dot_product * F.cross_entropy(t_preds_uh, hard_pseudo_label)
-
-            t_loss = t_loss_uda + t_loss_mpl
-            t_loss.backward()
-
-            self.optimizer_s.step()
-            self.optimizer_t.step()
-
-            t_losses += t_loss.item()
-            t_udas += t_loss_uda.item()
-            t_mpls += t_loss_mpl.item()
-            s_losses += s_loss.item()
-
-        t_losses /= len(self.unlabel_dl)
-        t_udas /= len(self.unlabel_dl)
-        t_mpls /= len(self.unlabel_dl)
-        s_losses /= len(self.unlabel_dl)
-
-        return t_losses, t_udas, t_mpls, s_losses
+        return t_loss_uda, t_preds_uh, soft_pseudo_label
+
+    def train_step(self, images_l, targets, images_us, images_uh):
+        """One MPL update of both models, accumulated over the engine's micro-batches.
+
+        The student is updated first; the teacher's MPL signal is the change of the student's
+        labeled loss caused by that update, measured with a forward of the updated student.
+
+        With several micro-batches the teacher first runs without a graph to produce the pseudo
+        labels, and is forwarded again per micro-batch for its own update once the student
+        feedback (which needs the whole batch) is known.
+        """
+        slices = self.engine.chunks(images_l.size(0))
+        if len(slices) > 1:
+            teacher_out = None
+            with torch.no_grad(), _disable_tracking_bn_stats(self.teacher):
+                soft_pseudo_labels = [self.teacher_forward(images_l[s], targets[s], images_us[s], images_uh[s])[2]
+                                      for s in slices]
+        else:
+            teacher_out = [self.teacher_forward(images_l, targets, images_us, images_uh)]
+            soft_pseudo_labels = [teacher_out[0][2]]
+
+        s_loss, dot_product = self.student_step(images_l, targets, images_uh, soft_pseudo_labels)
+        t_loss_uda, t_loss_mpl = self.teacher_step(images_l, targets, images_us, images_uh, dot_product, teacher_out)
+        return t_loss_uda + t_loss_mpl, t_loss_uda, t_loss_mpl, s_loss
+
+    def teacher_pseudo_labels(self, images_us):
+        """Hard pseudo labels of every micro-batch for ``--mpl_pipeline``, from a teacher forward of
+        the weak views only (BN uses their batch statistics rather than those of the joint
+        ``teacher_forward``), without a graph and without touching the BN running statistics."""
+        with self.engine.timer.stage('teacher_forward'), torch.no_grad(), \
+                _disable_tracking_bn_stats(self.teacher), self.engine.autocast():
+            return [self.teacher(images_us[s]).argmax(dim=-1) for s in self.engine.chunks(images_us.size(0))]
+
+    def student_step(self, images_l, targets, images_uh, soft_pseudo_labels, end_step=False):
+        """Updates the student on the pseudo labels of every micro-batch.
+
+        Returns the student loss and the teacher's feedback, the change of the student's labeled
+        loss averaged over ranks.
+        """
+        n = images_l.size(0)
+        slices = self.engine.chunks(n)
+        weights = [(s.stop - s.start) / n for s in slices]
+
+        # Student는 labelset과 hard_transfrom된 이미지 사용
+        s_loss = s_loss_l_old = 0
+        for s, w, soft_pseudo_label in zip(slices, weights, soft_pseudo_labels):
+            with self.engine.timer.stage('student_forward'), self.engine.no_sync(s.stop == n, [self.student]), \
+                    self.engine.autocast():
+                s_preds = self.student(torch.cat([images_l[s], images_uh[s]]))
+                s_preds_l = s_preds[:s.stop - s.start]
+                s_preds_uh = s_preds[s.stop - s.start:]
+                del s_preds
+
+                loss_l = F.cross_entropy(s_preds_l.detach(), targets[s])  # Teacher가 학습하기 위한 loss 계산(학습 전)
+                s_loss_l_old += loss_l.detach() * w
+                loss = self.criterion(s_preds_uh, soft_pseudo_label)  # Student는 Teacher로 인한 soft_psuedo_label를 이용하여 학습
+                self.engine.backward(loss * w)
+            s_loss += loss.detach() * w
+
+        self.engine.update(self.optimizer_s, end_step=end_step)
+
+        with self.engine.timer.stage('student_feedback'), torch.no_grad(), self.engine.autocast():
+            s_loss_l_new = 0
+            for s, w in zip(slices, weights):
+                s_preds_l = self.student(images_l[s])
+                s_loss_l_new += F.cross_entropy(s_preds_l, targets[s]) * w  # Teacher가 학습하기 위한 loss 계산(학습 후)
+            change = s_loss_l_new - s_loss_l_old
+
+        # Student의 labelset에 대한 학습 전과 학습 후의 loss 차이 (student의 update처럼 전체 rank의 batch 기준)
+        return s_loss, reduce_mean(change)
+
+    def teacher_step(self, images_l, targets, images_us, images_uh, dot_product, teacher_out=None, end_step=True):
+        """Updates the teacher with its UDA loss and the MPL loss scaled by the student's feedback.
+
+        ``teacher_out`` holds the outputs of a ``teacher_forward`` with a graph for every
+        micro-batch; without it the teacher is forwarded again.
+        """
+        n = images_l.size(0)
+        slices = self.engine.chunks(n)
+        weights = [(s.stop - s.start) / n for s in slices]
+
+        t_loss_uda = t_loss_mpl = 0
+        for i, (s, w) in enumerate(zip(slices, weights)):
+            with self.engine.no_sync(s.stop == n, [self.teacher]):
+                if teacher_out is None:
+                    out = self.teacher_forward(images_l[s], targets[s], images_us[s], images_uh[s])
+                else:
+                    out = teacher_out[i]
+                uda, t_preds_uh, _ = out
+                _, hard_pseudo_label = torch.max(t_preds_uh.detach(), dim=-1)
+
+                with self.engine.autocast():
+                    mpl = dot_product * F.cross_entropy(t_preds_uh, hard_pseudo_label)
+                self.engine.backward((uda + mpl) * w)
+            t_loss_uda += uda.detach() * w
+            t_loss_mpl += mpl.detach() * w
+
+        self.engine.update(self.optimizer_t, end_step=end_step)
+        return t_loss_uda, t_loss_mpl
 
     def finetune(self):
         self.args.lr /= 2
@@ -228,18 +437,16 @@ class Trainer():
         start = time.time()
 
         # Early stopping
-        best_epoch = 0
-        best_loss = np.inf
-        best_acc = 0
-        best_acc2 = 0
-        early_stopping = 0
+        self.stopper = EarlyStopping(self.args.patience)
+        start_epoch, start_step = self.run.restore('finetune', self.state_objects())
 
-        for epoch in range(self.args.epochs):
+        for epoch in range(start_epoch, self.args.epochs):
             if self.args.scheduler == 'cos':
-                if epoch > self.args.warm_epoch:
+                if epoch > self.args.warm_epoch and not start_step:
                     self.scheduler_s.step()
 
-            train_loss, train_top1, train_top5 = self.finetune_one_epoch()
+            train_loss, train_top1, train_top5 = self.finetune_one_epoch(epoch, start_step)
+            start_step = 0
             val_loss, val_top1, val_top5 = self.validate()
 
             if self.writer is not None:
@@ -253,102 +460,81 @@ class Trainer():
 
             print(f'Epoch : {epoch} | Train Loss:{train_loss:.4f} | Train Top1:{train_top1:.4f} | Train Top5:{train_top5:.4f}')
             print(f'Epoch : {epoch} | Val Loss:{val_loss:.4f}   | Val Top1:{val_top1:.4f}   | Val Top5:{val_top5:.4f}')
-            state_dict = self.student.state_dict()
-
-            if val_top1 > best_acc:
-                early_stopping = 0
-                best_epoch = epoch
-                best_loss = val_loss
-                best_acc = val_top1
-                best_acc2 = val_top5
-
-                torch.save({'epoch' :epoch,
-                            'state_dict' :state_dict,
-                            'optimizer': self.optimizer_s.state_dict(),
-                            'scheduler': self.scheduler_s.state_dict(),
-                            }, os.path.join(self.save_path, 'best_model_finetune.pth'))
-            else:
-                early_stopping += 1
+            state_dict = unwrap(self.student).state_dict()
+
+            if self.stopper.update(epoch, val_loss, val_top1, val_top5):
+                self.checkpoint.save({'epoch' :epoch,
+                                      'state_dict' :state_dict,
+                                      'optimizer': self.optimizer_s.state_dict(),
+                                      'scheduler': self.scheduler_s.state_dict(),
+                                      }, os.path.join(self.save_path, 'best_model_finetune.pth'))
 
-            if early_stopping == args.patience:
+            self.run.save('finetune', self.args.epochs if self.stopper.stop else epoch + 1, 0, self.state_objects())
+            if self.stopper.stop:
                 break
 
             if self.writer is not None:
-                self.writer.add_scalar('Finetune/Best/top1_accuracy', best_acc, epoch)
-                self.writer.add_scalar('Finetune/Best/top5_accuracy', best_acc2, epoch)
-                self.writer.add_scalar('Finetune/Best/loss', best_loss, epoch)
+                self.writer.add_scalar('Finetune/Best/top1_accuracy', self.stopper.best_acc, epoch)
+                self.writer.add_scalar('Finetune/Best/top5_accuracy', self.stopper.best_acc2, epoch)
+                self.writer.add_scalar('Finetune/Best/loss', self.stopper.best_loss, epoch)
 
         end = time.time()
-        print(f'Best Epoch:{best_epoch} | Loss:{best_loss:.4f} | Top1:{best_acc:.4f} | Top5:{best_acc2:.4f}')
+        print(f'Best Epoch:{self.stopper.best_epoch} | Loss:{self.stopper.best_loss:.4f} | Top1:{self.stopper.best_acc:.4f} | Top5:{self.stopper.best_acc2:.4f}')
         print(f'Total Training time:{(end - start) / 60:.3f}Minute')
 
-    def finetune_one_epoch(self):
+    def finetune_one_epoch(self, epoch, start_step=0):
         self.student.train()
-        train_loss = 0
-        top1 = 0
-        top5 = 0
-
-        for images, targets in tqdm(self.train_dl):
-            images = torch.tensor(images, device=self.device, dtype=torch.float32)
-            targets = torch.tensor(targets, device=self.device, dtype=torch.long)
+        meter = MetricMeter(self.device, log_interval=self.args.log_interval)
+        self.run.load('meter', meter)
+        seek_loader(self.train_dl, epoch, start_step)
 
+        pbar = tqdm(self.engine.timer.iterate(self.train_dl, self.writer), total=len(self.train_dl), initial=start_step)
+        for step, (images, targets) in enumerate(pbar, start_step + 1):
             self.student.zero_grad(set_to_none=True)
 
-            preds = self.student(images)
-
-            loss = self.criterion(preds, targets)
-            loss.backward()
+            loss, preds = self.engine.accumulate(self.finetune_step, (images, targets), self.optimizer_s)
 
-            self.optimizer_s.step()
+            meter.update(targets.size(0), preds, targets, loss=loss)
+            meter.log(pbar)
+            if self.run.due(step):
+                self.run.save('finetune', epoch, step, dict(self.state_objects(), meter=meter))
 
-            t1, t5 = accuracy(preds, targets, (1, 5))
-            train_loss += loss.item()
-            top1 += t1
-            top5 += t5
+        self.engine.timer.save(os.path.join(self.save_path, 'timing.jsonl'), phase='finetune', epoch=epoch)
+        return meter.compute('loss', 'top1', 'top5') #train_acc
 
-        top1 /= len(self.train_dl)
-        top5 /= len(self.train_dl)
-        train_loss /= len(self.train_dl)
+    def finetune_step(self, images, targets):
+        with self.engine.autocast():
+            preds = self.student(images)
 
-        return train_loss, top1, top5 #train_acc
+            loss = self.criterion(preds, targets)
+        return loss, preds
 
     def validate(self):
         self.student.eval()
-        with torch.no_grad():
-            val_loss = 0
-            top1 = 0
-            top5 = 0
+        with torch.no_grad(), self.engine.autocast():
+            meter = MetricMeter(self.device)
 
             for images, targets in tqdm(self.val_dl):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
-                targets = torch.tensor(targets, device=self.device, dtype=torch.long)
-
                 preds = self.student(images)
                 loss = self.criterion(preds, targets)
 
                 # Metric
-                t1, t5 = accuracy(preds, targets, (1, 5))
-                val_loss += loss.item()
-                top1 += t1
-                top5 += t5
-
-            top1 /= len(self.val_dl)
-            top5 /= len(self.val_dl)
-            val_loss /= len(self.val_dl)
+                meter.update(targets.size(0), preds, targets, loss=loss)
 
-        return val_loss, top1, top5
+        return meter.compute('loss', 'top1', 'top5')
 
     def test(self):
         pass
 
 if __name__ == '__main__':
     args = getConfig()
+    init_distributed(args)
 
     print('<---- Training Params ---->')
     pprint.pprint(args)
 
     # Random Seed
-    seed = args.seed
+    seed = args.seed + get_rank()
     os.environ['PYTHONHASHSEED'] = str(seed)
     random.seed(seed)
     np.random.seed(seed)
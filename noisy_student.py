@@ -17,7 +17,11 @@ from torch.utils.tensorboard import SummaryWriter
 from model import *
 from utils import *
 from config import getConfig
-from datasets.loader_cifar import CIFAR10, get_augmentation
+from engine import Engine
+from checkpoint import CheckpointWriter, RunState, seek_loader
+from distributed import init_distributed, get_rank, is_main_process, unwrap, sampler_args, barrier, gather_strided
+from datasets.loader_cifar import CIFAR10Source
+from datasets.batch_augment import get_views, to_device_views
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -26,20 +30,26 @@ class Trainer():
     def __init__(self, args):
         self.args = args
         self.device = torch.device('cuda' if torch.cuda.is_available() and args.device == 'cuda' else 'cpu')
+        self.engine = Engine(self.device, args.amp, args.compile, args.micro_batch_size, args.time_stages)
         self.teacher = Network(args).to(self.device)
+        self.engine.compile(self.teacher)
 
-        self.train_ds = CIFAR10(args.data_path, split='label', download=True, transform=get_augmentation(ver=2), boundary=0)
-        self.unlabel_ds = CIFAR10(args.data_path, split='unlabel', download=True, transform=get_augmentation(ver=1), boundary=0)
-        self.val_ds = CIFAR10(args.data_path, split='valid', download=True, transform=get_augmentation(ver=1), boundary=0)
-        self.test_ds = CIFAR10(args.data_path, split='test', download=True, transform=get_augmentation(ver=1), boundary=0)
+        self.source = CIFAR10Source(args.data_path, download=True, boundary=0, num_valid=args.num_valid,
+                                    num_label=args.num_label, seed=args.split_seed)
+        self.train_ds = get_views(self.source.split('label'), [2], args)
+        self.unlabel_ds = get_views(self.source.split('unlabel'), [1], args)
+        self.val_ds = get_views(self.source.split('valid'), [1], args)
+        self.test_ds = get_views(self.source.split('test'), [1], args)
 
-        self.train_dl = DataLoader(self.train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-        self.unlabel_dl = DataLoader(self.unlabel_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
-        self.val_dl = DataLoader(self.val_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
-        self.test_dl = DataLoader(self.test_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        self.train_dl = to_device_views(DataLoader(self.train_ds, batch_size=args.batch_size, **sampler_args(self.train_ds, shuffle=True, seed=args.seed), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [2], args, self.device, timer=self.engine.timer)
+        self.unlabel_dl = to_device_views(DataLoader(self.unlabel_ds, batch_size=args.batch_size, **sampler_args(self.unlabel_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.val_dl = to_device_views(DataLoader(self.val_ds, batch_size=args.batch_size, **sampler_args(self.val_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
+        self.test_dl = to_device_views(DataLoader(self.test_ds, batch_size=args.batch_size, **sampler_args(self.test_ds, shuffle=False), num_workers=args.num_workers, pin_memory=self.device.type == 'cuda'), [1], args, self.device)
 
         self.save_path = args.save_path
-        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard else None
+        self.writer = SummaryWriter(self.save_path) if args.use_tensorboard and is_main_process() else None
+        self.checkpoint = CheckpointWriter()
+        self.run = RunState(args, self.checkpoint, range(args.steps + 1))
         self.criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
 
     def init_settings(self, args):
@@ -55,38 +65,49 @@ class Trainer():
         elif args.scheduler == 'cycle':
             self.scheduler = torch.optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=args.max_lr,
                                                               steps_per_epoch=iter_per_epoch, epochs=args.epochs)
+
+    def state_objects(self):
+        return {'model': unwrap(self.student), 'optimizer': self.optimizer, 'scheduler': self.scheduler,
+                'scaler': self.engine.scaler, 'stopper': self.stopper}
+
     def close_writer(self):
         if self.writer is not None:
             self.writer.close()
 
     def train(self):
         for step in range(self.args.steps):
-            self.train_noisy(step)
-            pth_files = torch.load(os.path.join(self.save_path, f'best_model_{step}.pth'))
+            if not self.run.done(step):
+                self.train_noisy(step)
+            if self.run.done(step + 1):
+                continue  # 재개할 step의 pseudo label은 그 직전 step의 best model로 만듦
+            self.checkpoint.wait()
+            barrier()  # rank 0 writes the checkpoint every rank loads
+            pth_files = torch.load(os.path.join(self.save_path, f'best_model_{step}.pth'), map_location=self.device)
             self.teacher.load_state_dict(pth_files['state_dict'])
             self.get_pseudo_label()
         self.train_noisy(step+1)
 
     def train_noisy(self, step):
+        self.noisy_step = step
         # Student Network 초기화
         self.student = Network(self.args).to(self.device)
+        self.engine.compile(self.student)
+        self.student = self.engine.distribute(self.student)
         self.init_settings(self.args)
         start = time.time()
 
         # Early stopping
-        best_epoch = 0
-        best_loss = np.inf
-        best_acc = 0
-        best_acc2 = 0
-        early_stopping = 0
+        self.stopper = EarlyStopping(self.args.patience)
+        start_epoch, start_step = self.run.restore(step, self.state_objects())
 
-        for epoch in range(self.args.epochs):
+        for epoch in range(start_epoch, self.args.epochs):
 
             if self.args.scheduler == 'cos':
-                if epoch > self.args.warm_epoch:
+                if epoch > self.args.warm_epoch and not start_step:
                     self.scheduler.step()
 
-            train_loss, train_top1, train_top5 = self.train_one_epoch()
+            train_loss, train_top1, train_top5 = self.train_one_epoch(epoch, start_step)
+            start_step = 0
             val_loss, val_top1, val_top5 = self.validate()
 
             if self.writer is not None:
@@ -101,122 +122,103 @@ class Trainer():
             print(
                 f'Epoch : {epoch} | Train Loss:{train_loss:.4f} | Train Top1:{train_top1:.4f} | Train Top5:{train_top5:.4f}')
             print(f'Epoch : {epoch} | Val Loss:{val_loss:.4f}   | Val Top1:{val_top1:.4f}   | Val Top5:{val_top5:.4f}')
-            state_dict = self.student.state_dict()
-
-            if val_top1 > best_acc:
-                early_stopping = 0
-                best_epoch = epoch
-                best_loss = val_loss
-                best_acc = val_top1
-                best_acc2 = val_top5
-
-                torch.save({'epoch': epoch,
-                            'state_dict': state_dict,
-                            'optimizer': self.optimizer.state_dict(),
-                            'scheduler': self.scheduler.state_dict(),
-                            }, os.path.join(self.save_path, f'best_model_{step}.pth'))
-            else:
-                early_stopping += 1
-
-            if early_stopping == args.patience:
+            state_dict = unwrap(self.student).state_dict()
+
+            if self.stopper.update(epoch, val_loss, val_top1, val_top5):
+                self.checkpoint.save({'epoch': epoch,
+                                      'state_dict': state_dict,
+                                      'optimizer': self.optimizer.state_dict(),
+                                      'scheduler': self.scheduler.state_dict(),
+                                      }, os.path.join(self.save_path, f'best_model_{step}.pth'))
+
+            self.run.save(step, self.args.epochs if self.stopper.stop else epoch + 1, 0, self.state_objects())
+            if self.stopper.stop:
                 break
 
             if self.writer is not None:
-                self.writer.add_scalar(f'{step}/Best/top1_accuracy', best_acc, epoch)
-                self.writer.add_scalar(f'{step}/Best/top5_accuracy', best_acc2, epoch)
-                self.writer.add_scalar(f'{step}/Best/loss', best_loss, epoch)
+                self.writer.add_scalar(f'{step}/Best/top1_accuracy', self.stopper.best_acc, epoch)
+                self.writer.add_scalar(f'{step}/Best/top5_accuracy', self.stopper.best_acc2, epoch)
+                self.writer.add_scalar(f'{step}/Best/loss', self.stopper.best_loss, epoch)
 
         end = time.time()
-        print(f'Best Epoch:{best_epoch} | Loss:{best_loss:.4f} | Top1:{best_acc:.4f} | Top5:{best_acc2:.4f}')
+        print(f'Best Epoch:{self.stopper.best_epoch} | Loss:{self.stopper.best_loss:.4f} | Top1:{self.stopper.best_acc:.4f} | Top5:{self.stopper.best_acc2:.4f}')
         print(f'Total Training time:{(end - start) / 60:.3f}Minute')
 
     def get_pseudo_label(self):
         self.teacher.eval()
-        with torch.no_grad():
-            prediction = []
+        with torch.no_grad(), self.engine.autocast():
+            max_probs = []
             pseudo_labels = []
             for images, _ in tqdm(self.unlabel_dl):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
-
-                preds = torch.softmax(self.teacher(images), dim=-1)
-                max_probs, pseudo_label = torch.max(preds, dim=-1)
-                prediction.extend([i.item() for i in max_probs])
-                pseudo_labels.extend([l.item() for l in pseudo_label])
-
-            indices = [i for i, p in enumerate(prediction) if p > self.args.threshold]
-            labels = [l for p, l in zip(prediction, pseudo_labels) if p > self.args.threshold]
-
-            self.pseudo_ds = CIFAR10(args.data_path, split='pseudo', download=True, transform=get_augmentation(ver=2), boundary=0, indices=indices, labels=labels)
-            self.new_ds = self.train_ds + self.pseudo_ds # Concat Train, Pseudo
-            self.train_dl = DataLoader(self.new_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-
-    def train_one_epoch(self):
+                preds = torch.softmax(self.teacher(images).float(), dim=-1)
+                max_prob, pseudo_label = torch.max(preds, dim=-1)
+                max_probs.append(max_prob)
+                pseudo_labels.append(pseudo_label)
+
+            max_probs = gather_strided(torch.cat(max_probs).cpu().numpy())
+            pseudo_labels = gather_strided(torch.cat(pseudo_labels).cpu().numpy())
+
+        # unlabel_dl is not shuffled, so positions in the predictions are positions in the unlabel split
+        # (each rank labels a strided slice, reassembled by gather_strided)
+        indices = np.flatnonzero(max_probs > self.args.threshold)
+        self.pseudo_ds = get_views(self.source.split('pseudo', indices=indices, labels=pseudo_labels[indices],
+                                                     confidences=max_probs[indices]), [2], self.args)
+        self.new_ds = self.train_ds + self.pseudo_ds # Concat Train, Pseudo
+        self.train_dl = to_device_views(DataLoader(self.new_ds, batch_size=self.args.batch_size, **sampler_args(self.new_ds, shuffle=True, seed=self.args.seed), num_workers=self.args.num_workers, pin_memory=self.device.type == 'cuda'), [2], self.args, self.device, timer=self.engine.timer)
+
+    def train_one_epoch(self, epoch, start_step=0):
         self.student.train()
-        train_loss = 0
-        top1 = 0
-        top5 = 0
-
-        for images, targets in tqdm(self.train_dl):
-            images = torch.tensor(images, device=self.device, dtype=torch.float32)
-            targets = torch.tensor(targets, device=self.device, dtype=torch.long)
+        meter = MetricMeter(self.device, log_interval=self.args.log_interval)
+        self.run.load('meter', meter)
+        seek_loader(self.train_dl, epoch, start_step)
 
+        pbar = tqdm(self.engine.timer.iterate(self.train_dl, self.writer), total=len(self.train_dl), initial=start_step)
+        for step, (images, targets) in enumerate(pbar, start_step + 1):
             self.student.zero_grad(set_to_none=True)
 
-            preds = self.student(images)
-
-            loss = self.criterion(preds, targets)
-            loss.backward()
+            loss, preds = self.engine.accumulate(self.train_step, (images, targets), self.optimizer)
 
-            self.optimizer.step()
+            meter.update(targets.size(0), preds, targets, loss=loss)
+            meter.log(pbar)
+            if self.run.due(step):
+                self.run.save(self.noisy_step, epoch, step, dict(self.state_objects(), meter=meter))
 
-            t1, t5 = accuracy(preds, targets, (1, 5))
-            train_loss += loss.item()
-            top1 += t1
-            top5 += t5
+        self.engine.timer.save(os.path.join(self.save_path, 'timing.jsonl'), phase=self.noisy_step, epoch=epoch)
+        return meter.compute('loss', 'top1', 'top5') #train_acc
 
-        top1 /= len(self.train_dl)
-        top5 /= len(self.train_dl)
-        train_loss /= len(self.train_dl)
+    def train_step(self, images, targets):
+        with self.engine.autocast():
+            preds = self.student(images)
 
-        return train_loss, top1, top5 #train_acc
+            loss = self.criterion(preds, targets)
+        return loss, preds
 
     def validate(self):
         self.student.eval()
-        with torch.no_grad():
-            val_loss = 0
-            top1 = 0
-            top5 = 0
+        with torch.no_grad(), self.engine.autocast():
+            meter = MetricMeter(self.device)
 
             for images, targets in tqdm(self.val_dl):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
-                targets = torch.tensor(targets, device=self.device, dtype=torch.long)
-
                 preds = self.student(images)
                 loss = self.criterion(preds, targets)
 
                 # Metric
-                t1, t5 = accuracy(preds, targets, (1, 5))
-                val_loss += loss.item()
-                top1 += t1
-                top5 += t5
-
-            top1 /= len(self.val_dl)
-            top5 /= len(self.val_dl)
-            val_loss /= len(self.val_dl)
+                meter.update(targets.size(0), preds, targets, loss=loss)
 
-        return val_loss, top1, top5
+        return meter.compute('loss', 'top1', 'top5')
 
     def test(self):
         pass
 
 if __name__ == '__main__':
     args = getConfig()
+    init_distributed(args)
 
     print('<---- Training Params ---->')
     pprint.pprint(args)
 
     # Random Seed
-    seed = args.seed
+    seed = args.seed + get_rank()
     os.environ['PYTHONHASHSEED'] = str(seed)
     random.seed(seed)
     np.random.seed(seed)
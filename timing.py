@@ -0,0 +1,133 @@
+import json
+import time
+import threading
+import contextlib
+from collections import defaultdict, deque
+
+import numpy as np
+from tqdm import tqdm
+import torch
+
+from distributed import is_main_process
+
+PERCENTILES = (50, 90, 99)
+
+
+class StageTimer(object):
+    """Opt-in (``--time_stages``) per-iteration timing of the stages of a training step.
+
+    ``iterate(loader)`` wraps the training loop: the time spent waiting for the next batch is
+    the ``data`` stage and every pass of the loop body is one step. Inside a step, code runs
+    under ``stage(name)``; the Engine times ``forward``, ``backward`` and ``optimizer``, the
+    DevicePrefetcher ``h2d`` and ``augment``, and losses can time their own passes (e.g. the
+    VAT power iteration and LDS). Stage times are exclusive: a nested stage is not counted in
+    the stage around it, and whatever is outside every stage is ``other``.
+
+    The device is synchronized at every stage boundary so the times are exact, which costs a
+    little throughput; nothing is done when disabled. Rolling percentiles over the last
+    ``window`` steps go to TensorBoard and ``save`` appends the epoch summary to a JSON file.
+    Only the thread that created the timer is timed; stages entered on other threads are ignored.
+    """
+    window = 100
+
+    def __init__(self, device, enabled=False):
+        self.device = device
+        self.enabled = enabled
+        self.stack = []
+        self.current = defaultdict(float)
+        self.recent = defaultdict(lambda: deque(maxlen=self.window))
+        self.epoch = defaultdict(list)
+        self.steps = 0
+        self.thread = threading.current_thread()
+
+    def _now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def stage(self, name):
+        if not self.enabled or threading.current_thread() is not self.thread:
+            return contextlib.nullcontext()
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        frame = [self._now(), 0.]  # start, time spent in nested stages
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = self._now() - frame[0]
+            self.current[name] += elapsed - frame[1]
+            if self.stack:
+                self.stack[-1][1] += elapsed
+
+    def iterate(self, loader, writer=None):
+        """Yields the batches of ``loader``, one step each, logging to ``writer`` every ``window`` steps."""
+        if not self.enabled:
+            yield from loader
+            return
+        self.current.clear()
+        iterator = iter(loader)
+        while True:
+            start = self._now()
+            try:
+                with self.stage('data'):
+                    batch = next(iterator)
+            except StopIteration:
+                self.current.clear()
+                return
+            yield batch
+            self._end_step(self._now() - start)
+            if writer is not None and self.steps % self.window == 0:
+                for name, value in self.percentiles(self.recent).items():
+                    writer.add_scalar(f'Time/{name}', value, self.steps)
+
+    def _end_step(self, total):
+        self.current['other'] = total - sum(self.current.values())
+        self.current['step'] = total
+        for name, value in self.current.items():
+            self.recent[name].append(value)
+            self.epoch[name].append(value)
+        self.current.clear()
+        self.steps += 1
+
+    def percentiles(self, times):
+        """``{'<stage>_p<q>': milliseconds}``; steps where a stage did not run count as 0."""
+        steps = len(times['step'])
+        out = {}
+        for name, values in times.items():
+            values = np.asarray(values)
+            values = np.concatenate([np.zeros(steps - len(values)), values]) * 1e3
+            for q in PERCENTILES:
+                out[f'{name}_p{q}'] = float(np.percentile(values, q))
+        return out
+
+    def summary(self):
+        """Mean, percentiles and share of the step time of every stage over the epoch so far."""
+        steps = len(self.epoch['step'])
+        total = sum(self.epoch['step'])
+        stages = {}
+        for name, values in self.epoch.items():
+            ms = np.concatenate([np.zeros(steps - len(values)), values]) * 1e3
+            stages[name] = {'mean_ms': float(ms.mean()),
+                            **{f'p{q}_ms': float(np.percentile(ms, q)) for q in PERCENTILES},
+                            'share': sum(values) / total}
+        return {'steps': steps, 'stages': stages}
+
+    def save(self, path, **info):
+        """Appends ``info`` and the epoch summary to the JSON lines file ``path``, then starts a new epoch."""
+        if not self.enabled or not self.epoch['step']:
+            return
+        summary = self.summary()
+        self.epoch.clear()
+        if is_main_process():
+            with open(path, 'a') as f:
+                f.write(json.dumps(dict(info, **summary)) + '\n')
+            tqdm.write(self.format(summary))
+
+    def format(self, summary):
+        stages = sorted(summary['stages'].items(), key=lambda x: -x[1]['share'])
+        return 'Timing | ' + ' | '.join(f"{name}:{s['mean_ms']:.1f}ms ({s['share'] * 100:.0f}%)"
+                                        for name, s in stages if name != 'step')
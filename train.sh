@@ -11,4 +11,7 @@ python fixmatch.py --save_path=results/fix --epoch=100
 python AE.py --save_path=results/ae --epoch=100 --feature_dim=768
 python DAE.py --save_path=results/ae --epoch=100 --feature_dim=768
 python supcon.py --save_path=results/ae --epoch=100 --feature_dim=768 --temperature=0.7
-python simclr.py --save_path=results/ae --epoch=100 --feature_dim=768 --temperature=0.7
\ No newline at end of file
+python simclr.py --save_path=results/ae --epoch=100 --feature_dim=768 --temperature=0.7
+
+#Multi-process (DDP): one process per GPU, or several CPU processes with the gloo backend
+torchrun --nproc_per_node=4 train_sup.py --save_path=results/sup_ddp --epoch=100 --dist_backend=gloo
@@ -2,6 +2,7 @@ import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 
 
 
@@ -20,6 +21,109 @@ def accuracy(output, target, topk=(1,)):
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
+
+class MetricMeter(object):
+    """Accumulates an epoch's metrics on the device; only ``compute`` syncs with the host.
+
+    Losses are batch means and are weighted by the batch size ``n``, and top-k accuracies are
+    counted over every target seen, so results are exact sample-weighted averages even when the
+    last batch is partial. With ``log_interval`` > 0, ``log`` shows running averages on a tqdm
+    bar every ``log_interval`` updates. Under a process group the totals are all-reduced, so
+    every rank must call ``compute`` (and ``log``) at the same points.
+    """
+    def __init__(self, device, topk=(1, 5), log_interval=0):
+        self.device = device
+        self.topk = topk
+        self.log_interval = log_interval
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+        self.correct = torch.zeros(len(self.topk), device=self.device)
+        self.num_targets = 0
+        self.steps = 0
+
+    def update(self, n, preds=None, targets=None, **losses):
+        for name, loss in losses.items():
+            self.sums[name] = self.sums.get(name, 0) + loss.detach().float() * n
+        self.count += n
+        if preds is not None:
+            _, pred = preds.detach().topk(max(self.topk), 1, True, True)
+            correct = pred.eq(targets.reshape(-1, 1)).cumsum(1)
+            self.correct += correct[:, [k - 1 for k in self.topk]].sum(0)
+            self.num_targets += targets.size(0)
+        self.steps += 1
+
+    def compute(self, *names):
+        """Returns every average as a dict, or the values of ``names`` (a float for a single name)."""
+        totals = torch.cat([torch.stack([v for v in self.sums.values()]).reshape(-1)
+                            if self.sums else self.correct.new_zeros(0),
+                            self.correct, self.correct.new_tensor([self.count, self.num_targets])])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        *values, count, num_targets = totals.tolist()
+        values = [v / max(count, 1) for v in values[:len(self.sums)]] + \
+                 [v * 100.0 / max(num_targets, 1) for v in values[len(self.sums):]]
+        metrics = dict(zip(list(self.sums) + [f'top{k}' for k in self.topk], values))
+        if not names:
+            return metrics
+        if len(names) == 1:
+            return metrics[names[0]]
+        return tuple(metrics[name] for name in names)
+
+    def log(self, pbar):
+        if self.log_interval > 0 and self.steps % self.log_interval == 0:
+            pbar.set_postfix({k: round(v, 4) for k, v in self.compute().items()})
+
+    def state_dict(self):
+        return {'sums': dict(self.sums), 'count': self.count, 'correct': self.correct,
+                'num_targets': self.num_targets, 'steps': self.steps}
+
+    def load_state_dict(self, state):
+        self.sums = {k: v.to(self.device) for k, v in state['sums'].items()}
+        self.correct = state['correct'].to(self.device)
+        self.count, self.num_targets, self.steps = state['count'], state['num_targets'], state['steps']
+
+
+class EarlyStopping(object):
+    """Best validation result of a training phase and the number of epochs since it improved.
+
+    ``mode`` 'top1' keeps the epoch with the highest top-1 accuracy, 'loss' the one with the
+    lowest loss. ``stop`` turns True after ``patience`` epochs without improvement.
+    """
+    def __init__(self, patience, mode='top1'):
+        self.patience = patience
+        self.mode = mode
+        self.best_epoch = 0
+        self.best_loss = float('inf')
+        self.best_acc = 0
+        self.best_acc2 = 0
+        self.counter = 0
+
+    def update(self, epoch, loss, top1=0, top5=0):
+        """Records an epoch's validation result and returns whether it is the new best."""
+        improved = loss < self.best_loss if self.mode == 'loss' else top1 > self.best_acc
+        if improved:
+            self.counter = 0
+            self.best_epoch = epoch
+            self.best_loss = loss
+            self.best_acc = top1
+            self.best_acc2 = top5
+        else:
+            self.counter += 1
+        return improved
+
+    @property
+    def stop(self):
+        return self.counter >= self.patience
+
+    def state_dict(self):
+        return dict(vars(self))
+
+    def load_state_dict(self, state):
+        vars(self).update(state)
+
 ################################################################################
 # For Virtual Adversarial Training
 @contextlib.contextmanager
@@ -32,25 +136,53 @@ def _disable_tracking_bn_stats(model):
     yield
     model.apply(switch_attr)
 
+@contextlib.contextmanager
+def _eval_mode(model):
+    training = model.training
+    model.eval()
+    yield
+    model.train(training)
+
 def _l2_normalize(d):
     d_reshaped = d.view(d.shape[0], -1, *(1 for _ in range(d.dim() - 2)))
     d /= torch.norm(d_reshaped, dim=1, keepdim=True) + 1e-8
     return d
 
 class VATLoss(nn.Module):
-    def __init__(self, xi=10.0, eps=1.0, ip=1):
+    def __init__(self, xi=10.0, eps=1.0, ip=1, hvp='fd', timer=None):
         """VAT loss
         :param xi: hyperparameter of VAT (default: 10.0)
         :param eps: hyperparameter of VAT (default: 1.0)
         :param ip: iteration times of computing adv noise (default: 1)
+        :param hvp: Hessian-vector product of the power iteration, 'fd' or 'jvp' (default: 'fd')
+        :param timer: StageTimer timing the clean, power iteration and LDS passes (default: None)
+
+        The power iteration only differentiates with respect to the input perturbation, through
+        ``torch.func`` with the parameters detached, so it builds no graph to the weights and never
+        touches their ``.grad``. 'fd' takes the KL gradient at ``xi * d`` (a finite difference of
+        the gradient, as in the paper). 'jvp' computes the exact product with the KL Hessian at
+        ``x`` (the ``xi`` -> 0 limit of 'fd', ``xi`` is unused), J^T (diag(p) - p p^T) J d: J d with
+        a forward-mode jvp, J^T with a vjp whose graph is built once at ``x`` and reused by every
+        iteration.
         """
         super(VATLoss, self).__init__()
+        if hvp not in ('fd', 'jvp'):
+            raise ValueError(f'Unknown VAT Hessian-vector product {hvp!r}, expected fd or jvp')
         self.xi = xi
         self.eps = eps
         self.ip = ip
+        self.hvp = hvp
+        self.timer = timer
+
+    def _stage(self, name):
+        return self.timer.stage(name) if self.timer is not None else contextlib.nullcontext()
 
     def forward(self, model, x):
-        with torch.no_grad():
+        # DDP 모델이면 내부 module로 계산: LDS의 gradient는 학습 loss와 함께 한 번의 backward로 동기화됨
+        if isinstance(model, nn.parallel.DistributedDataParallel):
+            model = model.module
+
+        with self._stage('vat_clean'), torch.no_grad():
             pred = F.softmax(model(x), dim=1)
 
         # prepare random unit tensor
@@ -59,22 +191,38 @@ class VATLoss(nn.Module):
 
         with _disable_tracking_bn_stats(model):
             # calc adversarial direction
-            for _ in range(self.ip):
-                d.requires_grad_()
-                pred_hat = model(x + self.xi * d) #Add perturbation
-                logp_hat = F.log_softmax(pred_hat, dim=1)
-                adv_distance = F.kl_div(logp_hat, pred, reduction='batchmean')
-                adv_distance.backward()
-                d = _l2_normalize(d.grad)
-                model.zero_grad()
+            with self._stage('vat_power'):
+                d = self._power_iteration(model, x, pred, d)
 
             # calc LDS
-            r_adv = d * self.eps
-            pred_hat = model(x + r_adv)
-            logp_hat = F.log_softmax(pred_hat, dim=1)
-            lds = F.kl_div(logp_hat, pred, reduction='batchmean')
+            with self._stage('vat_lds'):
+                r_adv = d * self.eps
+                pred_hat = model(x + r_adv)
+                logp_hat = F.log_softmax(pred_hat, dim=1)
+                lds = F.kl_div(logp_hat, pred, reduction='batchmean')
 
         return lds
+
+    def _power_iteration(self, model, x, pred, d):
+        # parameter를 detach한 model: perturbation에 대해서만 미분
+        params = {name: p.detach() for name, p in model.named_parameters()}
+        logits = lambda inputs: torch.func.functional_call(model, params, (inputs,))
+
+        if self.hvp == 'fd':
+            adv_distance = lambda d: F.kl_div(F.log_softmax(logits(x + self.xi * d), dim=1), pred, reduction='batchmean')
+            for _ in range(self.ip):
+                d = _l2_normalize(torch.func.grad(adv_distance)(d))
+            return d
+
+        # autocast는 jvp의 tangent를 cast하지 않으므로 float32로 계산
+        with torch.autocast(x.device.type, enabled=False):
+            out, vjp_fn = torch.func.vjp(logits, x)
+            p = F.softmax(out.detach(), dim=1)
+            for _ in range(self.ip):
+                _, jd = torch.func.jvp(logits, (x,), (d,))
+                u = p * jd - p * (p * jd).sum(dim=1, keepdim=True)  # KL의 logit Hessian (diag(p) - p p^T) 곱
+                d = _l2_normalize(vjp_fn(u)[0])
+        return d
 ################################################################################
 
 # For SimCLR & SupCon